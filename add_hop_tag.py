@@ -1,14 +1,35 @@
 import os
-import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from jsonl_io import read_jsonl, dumps_line, external_sort, merge_join
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Add hop tag to JSONL files")
     parser.add_argument("-i", "--input_dir", type=str, help="Path to the input directory containing JSONL files")
     parser.add_argument("-t", "--tag_dir", type=str, help="Directory containing hop tag JSON files")
     parser.add_argument("-o", "--output_dir", type=str, help="Path to the output directory for JSONL files")
+    parser.add_argument("--streaming", action="store_true", help="Sort-merge on disk instead of loading all tags into memory (output is ordered by uniqueId)")
     return parser.parse_args()
 
+def list_tag_files(tag_dir):
+    with os.scandir(tag_dir) as it:
+        return [e.path for e in it if e.name.endswith('.jsonl') and e.is_file()]
+
+def load_tag_file(path):
+    """Return the uniqueId -> hop tag mapping of a single tag file."""
+    hop_tags = {}
+    for item in read_jsonl(path):
+        unique_id = item.get("uniqueId")
+        if unique_id:
+            hop_tags[unique_id] = item.get("hopType", "")
+    return hop_tags
+
+def iter_hop_tags(tag_dir):
+    """Yield (uniqueId, hop tag) for every tagged row in tag_dir."""
+    for path in list_tag_files(tag_dir):
+        yield from load_tag_file(path).items()
+
 if __name__ == "__main__":
     args = parse_args()
     input_dir = args.input_dir
@@ -19,31 +40,35 @@ if __name__ == "__main__":
     
     # Build a mapping from uniqueId to hop tag
     hop_tags = {}
-    for tag_file in os.listdir(tag_dir):
-        if tag_file.endswith('.jsonl'):
-            with open(os.path.join(tag_dir, tag_file), 'r', encoding='utf-8') as f:
-                tag_data = [json.loads(line) for line in f if line.strip()]
-            for item in tag_data:
-                unique_id = item.get("uniqueId")
-                hop_tag = item.get("hopType", "")
-                if unique_id:
-                    hop_tags[unique_id] = hop_tag
-    
-    print(hop_tags.items())     
+    if not args.streaming:
+        # Tag files are independent, so parse them in parallel
+        with ProcessPoolExecutor() as executor:
+            for file_tags in executor.map(load_tag_file, list_tag_files(tag_dir)):
+                hop_tags.update(file_tags)
+        print(f"Loaded {len(hop_tags)} hop tags")
+
     # Process each JSONL file in the input directory
-    for input_file in os.listdir(input_dir):
+    with os.scandir(input_dir) as it:
+        input_entries = list(it)
+    for input_entry in input_entries:
+        input_file = input_entry.name
         print('Processing file:', input_file)
         if input_file.endswith('.jsonl'):
-            with open(os.path.join(input_dir, input_file), 'r', encoding='utf-8') as infile, \
-                 open(os.path.join(output_dir, input_file), 'w', encoding='utf-8') as outfile:
-                
-                for line in infile:
-                    row = json.loads(line)
+            rows = read_jsonl(input_entry.path)
+            if args.streaming:
+                rows = merge_join(
+                    external_sort((str(row.get("uniqueId") or ""), row) for row in rows),
+                    external_sort(iter_hop_tags(tag_dir)),
+                )
+            else:
+                rows = ((row, hop_tags.get(row.get("uniqueId"), "")) for row in rows)
+            with open(os.path.join(output_dir, input_file), 'wb') as outfile:
+                for row, hop_tag in rows:
                     unique_id = row.get("uniqueId")
-                    hop_tag = hop_tags.get(unique_id, "")
+                    hop_tag = hop_tag or ""
                     if not hop_tag:
                         print(f"Warning: No hop tag found for uniqueId {unique_id}")
                     row["hopType"] = hop_tag
-                    outfile.write(json.dumps(row, ensure_ascii=False) + '\n')
+                    outfile.write(dumps_line(row))
                     
     
@@ -1,44 +1,87 @@
 import os
-import json
 import argparse
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+import orjson
+import pyarrow as pa
+
+from jsonl_io import read_jsonl, dumps_line, external_sort, merge_join
 
 ANNOTATORS = ["伊甯", "俞蓁", "家愷", "思齊", "悅媗", "禹融", "紫渝", "致堯", "郁玲"]
+JOIN_CHUNK_ROWS = 65536
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Add new columns to JSONL file")
     parser.add_argument("-i", "--input_file", type=str, help="Path to the input JSONL file")
     parser.add_argument("-s", "--suggestions_dir", type=str, help="Path to dir containing the suggestions JSON file")
     parser.add_argument("-o", "--output_file", type=str, help="Path to the output JSONL file")
+    parser.add_argument("--streaming", action="store_true", help="Sort-merge on disk instead of loading all suggestions into memory (output is ordered by uniqueId)")
     return parser.parse_args()
 
+def read_suggestions(suggestions_dir, annotator):
+    """Yield (uniqueId, new columns) for every suggestion of one annotator."""
+    with open(os.path.join(suggestions_dir, f"{annotator}.jsonl"), 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                suggestion = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                print(line.decode('utf-8', errors='replace'))
+                raise Exception("JSON Decode Error")
+                continue
+            unique_id = suggestion.get("uniqueId")
+            if unique_id:
+                yield unique_id, {"question": suggestion.get("question", ""), "options": suggestion.get("options", []), "annotator_1": annotator, "suggestion_1": suggestion.get("suggestion", "")}
+
+def load_suggestions(suggestions_dir, annotator):
+    return dict(read_suggestions(suggestions_dir, annotator))
+
+def iter_suggestions(suggestions_dir):
+    """Yield (uniqueId, new columns) for every suggestion, in annotator order."""
+    for annotator in ANNOTATORS:
+        yield from read_suggestions(suggestions_dir, annotator)
+
+def join_suggestions(rows, suggestions):
+    """Left-join suggestions onto rows by uniqueId with a pyarrow hash join, keeping input order."""
+    values = list(suggestions.values())
+    suggestion_index = pa.table({
+        "uniqueId": pa.array([str(unique_id) for unique_id in suggestions], pa.string()),
+        "suggestion_idx": pa.array(range(len(values)), pa.int64()),
+    })
+    rows = iter(rows)
+    while chunk := list(islice(rows, JOIN_CHUNK_ROWS)):
+        # Only the keys go through arrow; rows stay dicts so their key order and nested values survive
+        row_index = pa.table({
+            "uniqueId": pa.array([unique_id if isinstance((unique_id := row.get("uniqueId")), str) else None for row in chunk], pa.string()),
+            "row_idx": pa.array(range(len(chunk)), pa.int64()),
+        })
+        joined = row_index.join(suggestion_index, keys="uniqueId", join_type="left outer").sort_by("row_idx")
+        for row, idx in zip(chunk, joined["suggestion_idx"].to_pylist()):
+            yield add_columns(row, values[idx] if idx is not None else None)
+
+def add_columns(row, suggestion):
+    if suggestion is not None:
+        row.update(suggestion)
+    else:
+        row.update({"annotator_1": "", "suggestion_1": ""})
+    return row
+
 if __name__ == "__main__":
     args = parse_args()
 
-    suggestions = {}
-    # Load suggestions from the provided JSON file
-    for annotator in ANNOTATORS:
-        with open(os.path.join(args.suggestions_dir, f"{annotator}.jsonl"), 'r', encoding='utf-8') as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                try:
-                    suggestion = json.loads(line)
-                except json.JSONDecodeError:
-                    print(line)
-                    raise Exception("JSON Decode Error")
-                    continue
-                unique_id = suggestion.get("uniqueId")
-                if unique_id:
-                    suggestions[unique_id] = {"question": suggestion.get("question", ""), "options": suggestion.get("options", []), "annotator_1": annotator, "suggestion_1": suggestion.get("suggestion", "")}
-
-    with open(args.input_file, 'r', encoding='utf-8') as input_file, \
-         open(args.output_file, 'w', encoding='utf-8') as output_file:
-
-        for line in input_file:
-            row = json.loads(line)
-            unique_id = row.get("uniqueId")
-            if unique_id in suggestions:
-                row.update(suggestions[unique_id])
-            else:
-                row.update({"annotator_1": "", "suggestion_1": ""})
-            output_file.write(json.dumps(row, ensure_ascii=False) + '\n')
+    with open(args.output_file, 'wb') as output_file:
+        if args.streaming:
+            rows = external_sort((str(row.get("uniqueId") or ""), row) for row in read_jsonl(args.input_file))
+            suggestions = external_sort(iter_suggestions(args.suggestions_dir))
+            for row, suggestion in merge_join(rows, suggestions):
+                output_file.write(dumps_line(add_columns(row, suggestion)))
+        else:
+            # Load suggestions from the provided JSON files, one annotator per worker
+            suggestions = {}
+            with ProcessPoolExecutor() as executor:
+                for annotator_suggestions in executor.map(load_suggestions, [args.suggestions_dir] * len(ANNOTATORS), ANNOTATORS):
+                    suggestions.update(annotator_suggestions)
+            for row in join_suggestions(read_jsonl(args.input_file), suggestions):
+                output_file.write(dumps_line(row))
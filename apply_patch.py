@@ -1,7 +1,14 @@
-import json
 import os
+import re
 import argparse
 
+import orjson
+
+from jsonl_io import read_jsonl, write_jsonl, dumps_line, external_sort, merge_join
+
+# Unescaped audioPath value of a raw JSONL line
+AUDIO_PATH_RE = re.compile(rb'"audioPath"\s*:\s*"([^"\\]*)"')
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Apply patch to JSONL file.")
     parser.add_argument(
@@ -25,29 +32,44 @@ def parse_args():
         required=True,
         help="Path to the patch JSON file.",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Sort-merge on disk instead of loading the input into memory (output is ordered by audioPath).",
+    )
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
 
-    with open(args.input_file, 'r', encoding='utf-8') as f:
-        data = [json.loads(line) for line in f]
-
-    patches = {}
-    with open(args.patch_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            patch = json.loads(line)
-            patches[patch['audioPath']] = patch
-
-    # Apply patches
-    for item in data:
-        audio_path = item.get('audioPath')
-        if audio_path in patches:
-            item['startMs'] = patches[audio_path]['startMs']
-            item['endMs'] = patches[audio_path]['endMs']
-
-    with open(args.output_file, 'w') as f:
-        for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+    if args.streaming:
+        data = external_sort((str(item.get('audioPath') or ''), item) for item in read_jsonl(args.input_file))
+        patches = external_sort((patch['audioPath'], (patch['startMs'], patch['endMs'])) for patch in read_jsonl(args.patch_file))
+        patched = (
+            item if patch is None else {**item, 'startMs': patch[0], 'endMs': patch[1]}
+            for item, patch in merge_join(data, patches)
+        )
+        write_jsonl(args.output_file, patched)
+    else:
+        # Only the new (startMs, endMs) pair is needed from each patch
+        patches = {}
+        for patch in read_jsonl(args.patch_file):
+            patches[patch['audioPath'].encode()] = (patch['startMs'], patch['endMs'])
+
+        # Lines whose audioPath has no patch are copied through without decoding; lines
+        # with more than one "audioPath" (e.g. a nested key) are parsed to find the top-level one
+        with open(args.input_file, 'rb') as infile, open(args.output_file, 'wb') as outfile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                match = AUDIO_PATH_RE.search(line) if line.count(b'"audioPath"') == 1 else None
+                if match and match.group(1) not in patches:
+                    outfile.write(line if line.endswith(b'\n') else line + b'\n')
+                    continue
+                item = orjson.loads(line)
+                audio_path = item.get('audioPath')
+                if isinstance(audio_path, str) and audio_path.encode() in patches:
+                    item['startMs'], item['endMs'] = patches[audio_path.encode()]
+                outfile.write(dumps_line(item))
 
     print(f"Patched data saved to {args.output_file}")
\ No newline at end of file
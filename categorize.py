@@ -1,15 +1,20 @@
-import json
 import os
+import time
 from typing import List, Dict, Optional
 import argparse
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import orjson
 import pandas as pd
 from tqdm import tqdm
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
+from gemini_utils import AudioFileCache, compute_cost, make_client
+from jsonl_io import read_jsonl, dumps_line
+
 # Prompt template for generating questions
 GUIDE = """大眾運輸信號聲 (Transit)
  定義：用於捷運、高鐵、台鐵、公車等交通工具的進／出站提示、門開關、警示及行駛聲響。
@@ -60,42 +65,67 @@ GUIDE = """大眾運輸信號聲 (Transit)
  定義：遊樂場、遊戲機台、拍賣、演唱會、卡拉OK 等休閒娛樂相關的音效與音樂。
  範例：夾娃娃下爪聲、夜市射氣球聲、麻將聲、卡拉OK歡唱台語老歌、湯姆熊遊樂場環境音。
 """
-PROMPT_TEMPLATE = f"""請根據以下分類指引對一個音檔的描述「%s」進行分類：
-
-{GUIDE}
-
-請分析音檔內容並按照以下JSON格式輸出：
+OUTPUT_FORMAT = """請分析音檔內容並按照以下JSON格式輸出：
 
 ```json
-{{
+{
   "category": "[分類名稱對應的英文單字]",
   "confidence": [1-10的整數]
-}}
+}
 ```
 """
+# The description is spliced between a constant prefix and suffix
+PROMPT_PREFIX = "請根據以下分類指引對一個音檔的描述「"
+PROMPT_SUFFIX = f"""」進行分類：
+
+{GUIDE}
+
+{OUTPUT_FORMAT}"""
+# When GUIDE sits in a context cache, only the description and output format are sent
+CACHED_GUIDE_INSTRUCTION = f"""以下是音檔的分類指引：
+
+{GUIDE}"""
+CACHED_PROMPT_PREFIX = "請根據分類指引對一個音檔的描述「"
+CACHED_PROMPT_SUFFIX = f"""」進行分類：
+
+{OUTPUT_FORMAT}"""
 
 CLASSES = ["Transit", "Payment", "Retail", "Announcement", "Emergency", "Cultural", "Nature", "Education", "Media", "Entertainment"]
+MODEL_NAME = "gemini-2.5-flash"
 INPUT_COST = 0.3e-6
+CACHED_INPUT_COST = 0.075e-6
 AUDIO_COST = 1.0e-6
 OUTPUT_COST = 2.5e-6
+INPUT_RATES = {types.Modality.AUDIO: AUDIO_COST, types.Modality.TEXT: INPUT_COST}
+
+
+def create_guide_cache(client: genai.Client, ttl: int) -> Optional[types.CachedContent]:
+    """Cache GUIDE on the server so requests only carry the description."""
+    try:
+        return client.caches.create(
+            model=MODEL_NAME,
+            config=types.CreateCachedContentConfig(
+                system_instruction=CACHED_GUIDE_INSTRUCTION,
+                ttl=f"{ttl}s",
+            ),
+        )
+    except Exception as e:
+        print(f"Context caching unavailable, sending GUIDE inline: {e}")
+        return None
 
 
 def parse_json_response(response_text: str) -> tuple[str, int]:
     """Parse and validate JSON response from the API."""
     try:
         # Extract JSON from response
+        response_text = response_text.strip()
         if "```json" in response_text:
-            json_content = (
-                response_text.strip()
-                .split("```json")[1]
-                .strip()
-                .split("```")[0]
-                .strip()
-            )
+            _, _, rest = response_text.partition("```json")
+            json_content = rest.partition("```")[0].strip()
         else:
-            json_content = response_text.strip()
+            json_content = response_text
 
-        answer = json.loads(json_content)
+        answer = orjson.loads(json_content)
 
         if isinstance(answer, dict) and "category" in answer and "confidence" in answer:
             category = answer["category"]
@@ -110,52 +140,46 @@ def parse_json_response(response_text: str) -> tuple[str, int]:
             print("Invalid JSON structure or missing fields.")
             return "", 0
 
-    except (json.JSONDecodeError, Exception):
+    except (orjson.JSONDecodeError, Exception):
         return "", 0
 
 
 def generate_questions_for_audio(
-    client: genai.Client, audio_path: str, description: str, max_retries: int = 3
+    client: genai.Client,
+    audio_files: AudioFileCache,
+    audio_path: str,
+    description: str,
+    max_retries: int = 3,
+    cache_name: Optional[str] = None,
 ) -> tuple[Optional[str], float]:
     """Generate questions for a single audio file with retry logic."""
-    prompt = PROMPT_TEMPLATE % (description.strip())
+    if cache_name:
+        prompt = f"{CACHED_PROMPT_PREFIX}{description.strip()}{CACHED_PROMPT_SUFFIX}"
+    else:
+        prompt = f"{PROMPT_PREFIX}{description.strip()}{PROMPT_SUFFIX}"
 
-    # Read audio file
-    try:
-        with open(audio_path, "rb") as audio_file:
-            audio_content = audio_file.read()
-    except Exception:
-        return None
+    if not os.path.exists(audio_path):
+        return None, 0
 
     # Retry logic for API calls
     for attempt in range(max_retries):
         try:
+            # Upload once and reference the file handle on every attempt
+            audio_file = audio_files.get(audio_path)
             response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=[
-                    prompt,
-                    types.Part.from_bytes(
-                        data=audio_content,
-                        mime_type="audio/mp3",
-                    ),
-                ],
+                model=MODEL_NAME,
+                contents=[prompt, audio_file],
                 config=types.GenerateContentConfig(
+                    cached_content=cache_name,
                     thinking_config=types.ThinkingConfig(
                         thinking_budget=8192,
-                    )
+                    ),
                 ),
             )
-            output_cost = (
-                response.usage_metadata.candidates_token_count
-                + response.usage_metadata.thoughts_token_count
-            ) * OUTPUT_COST
-            input_cost = 0
-            for modality in response.usage_metadata.prompt_tokens_details:
-                if modality.modality == types.Modality.AUDIO:
-                    input_cost += modality.token_count * AUDIO_COST
-                elif modality.modality == types.Modality.TEXT:
-                    input_cost += modality.token_count * INPUT_COST
-            total_cost = input_cost + output_cost
+            total_cost = compute_cost(response, INPUT_RATES, OUTPUT_COST)
+            # Cached GUIDE tokens are billed at the cached rate
+            cached_tokens = response.usage_metadata.cached_content_token_count or 0
+            total_cost -= cached_tokens * (INPUT_COST - CACHED_INPUT_COST)
             category, confidence = parse_json_response(response.text)
 
             if not category or confidence < 1 or confidence > 10:
@@ -198,6 +222,23 @@ def parse_args():
         default=3,
         help="Number of retries for API calls in case of failure (default: 3).",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=16,
+        help="Number of concurrent API requests (default: 16). Rows are written in completion order.",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=int,
+        default=3600,
+        help="Lifetime in seconds of the GUIDE context cache, refreshed while running (default: 3600).",
+    )
+    parser.add_argument(
+        "--no_context_cache",
+        action="store_true",
+        help="Send GUIDE inline with every request instead of caching it.",
+    )
     return parser.parse_args()
 
 
@@ -214,30 +255,68 @@ def main():
         print("GEMINI_API_KEY not found in environment variables")
         return
 
-    client = genai.Client(api_key=api_key)
+    # One shared client, pooled for all worker threads
+    client = make_client(api_key, max_connections=args.num_workers)
 
     # Load input data
-    with open(args.input_file, "r", encoding='utf-8') as f:
-        data = [json.loads(line) for line in f]
+    data = list(read_jsonl(args.input_file))
 
     print(f"Loaded {len(data)} audio files from {args.input_file}")
 
     total_cost = 0.0
 
-    for index, row in enumerate(tqdm(data, total=len(data), desc="Processing Rows")):
-        category, cost = generate_questions_for_audio(
-            client, row["audio"][0]["audio_path"], row["description"], max_retries=args.max_retries
-        )
-
-        if category:
-            with open(args.output_file, "a", encoding='utf-8') as f:
-                row.update({
-                    "type": category,
-                })
-                f.write(json.dumps(row, ensure_ascii=False) + "\n")
-
-        total_cost += cost
+    cache = None if args.no_context_cache else create_guide_cache(client, args.cache_ttl)
+    cache_name = cache.name if cache else None
+    cache_refreshed_at = time.time()
+    audio_files = AudioFileCache(client)
 
+    try:
+        # API calls are I/O bound, so keep several in flight and write results as they finish
+        with open(args.output_file, "ab", buffering=1 << 16) as out_f, \
+             ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = {
+                executor.submit(
+                    generate_questions_for_audio,
+                    client,
+                    audio_files,
+                    row["audio"][0]["audio_path"],
+                    row["description"],
+                    max_retries=args.max_retries,
+                    cache_name=cache_name,
+                ): row
+                for row in data
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Rows"):
+                row = futures[future]
+                category, cost = future.result()
+
+                # Extend the cache before it expires under long runs
+                if cache and time.time() - cache_refreshed_at > args.cache_ttl / 2:
+                    try:
+                        client.caches.update(
+                            name=cache_name,
+                            config=types.UpdateCachedContentConfig(ttl=f"{args.cache_ttl}s"),
+                        )
+                    except Exception as e:
+                        print(f"Failed to extend context cache {cache_name}: {e}")
+                    cache_refreshed_at = time.time()
+
+                if category:
+                    row.update({
+                        "type": category,
+                    })
+                    out_f.write(dumps_line(row))
+                    out_f.flush()  # Keep partial results on disk if the run dies
+
+                total_cost += cost
+    finally:
+        # Stop paying for cache storage once the run is over
+        if cache:
+            try:
+                client.caches.delete(name=cache_name)
+            except Exception as e:
+                print(f"Failed to delete context cache {cache_name}: {e}")
+        audio_files.delete_all()
 
     print(f"Total API cost: ${total_cost:.6f}")
 
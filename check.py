@@ -1,35 +1,43 @@
 import os
-import json
 import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from jsonl_io import read_jsonl
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Check distribution of JSONL entries among annotators")
     parser.add_argument("-d", "--directory", type=str, help="Path to the directory containing annotator JSONL files")
     return parser.parse_args()
 
+def parse_file(path):
+    return list(read_jsonl(path))
+
 if __name__ == "__main__":
     # Check if each entry is assigned to exactly two annotators and count entries per annotator
     args = parse_args()
-    annotator_files = [f for f in os.listdir(args.directory) if f.endswith('.jsonl')]
-    annotator_entries = {}
-    for file in annotator_files:
-        with open(os.path.join(args.directory, file), 'r', encoding='utf-8') as f:
-            entries = [json.loads(line) for line in f if line.strip()]
-            annotator_entries[file] = entries
+    with os.scandir(args.directory) as it:
+        annotator_paths = {e.name: e.path for e in it if e.name.endswith('.jsonl') and e.is_file()}
+    annotator_files = list(annotator_paths)
+    # Parsing is CPU bound, so spread the files over worker processes
+    with ProcessPoolExecutor() as executor:
+        annotator_entries = dict(zip(annotator_files, executor.map(parse_file, annotator_paths.values())))
 
-    entry_count = {}
+    per_file_count = {annotator: len(entries) for annotator, entries in annotator_entries.items()}
+    per_uid_count = Counter()
     for annotator, entries in annotator_entries.items():
-        entry_count[annotator] = len(entries)
-        for entry in entries:
-            entry_id = entry.get("uniqueId")
-            if entry_id not in entry_count:
-                entry_count[entry_id] = 0
-            entry_count[entry_id] += 1
+        unique_ids = [e.get("uniqueId") for e in entries]
+        per_uid_count.update(unique_ids)
         # Check if there is no duplicate entries for the same annotator
-        if len(entries) != len(set(e.get("uniqueId") for e in entries)):
+        num_unique = len(set(unique_ids))
+        if len(entries) != num_unique:
             print(f"Duplicate entries found for annotator file: {annotator}")
-        print(len(entries), len(set(e.get("uniqueId") for e in entries)))
+        print(len(entries), num_unique)
+
+    not_doubled = sum(1 for count in per_uid_count.values() if count != 2)
+    if not_doubled:
+        print(f"Entries not assigned to exactly two annotators: {not_doubled}")
 
     # Print total entries count of all annotators
-    total_entries = sum(entry_count[annotator] for annotator in annotator_entries)
-    print(f"Total entries assigned to annotators: {total_entries}")
\ No newline at end of file
+    total_entries = sum(per_file_count.values())
+    print(f"Total entries assigned to annotators: {total_entries}")
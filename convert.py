@@ -1,7 +1,15 @@
-import json
-import csv
 import argparse
-import random
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from jsonl_io import write_jsonl
+
+AUDIO_URL_PREFIX = "https://huggingface.co/datasets/chenjoachim/TAU-dataset/resolve/main/"
+OPTION_COLUMNS = ["A", "B", "C", "D"]
+# All 24 orderings of the four options, sampled by row
+PERMS = np.array(list(itertools.permutations(range(len(OPTION_COLUMNS)))))
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Convert CSV to JSONL")
@@ -10,31 +18,31 @@ def parse_args():
     return parser.parse_args()
 
 def main(args):
-    with open(args.input_file, 'r', encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        data = [row for row in csv_reader]
-
-    with open(args.output_file, 'w', encoding='utf-8') as jsonl_file:
-        for row in data:
-            new_row = {}
-            new_row["type"] = row["type"]
-            new_row["description"] = row["description"]
-            new_row["link"] = row["link"]
-            new_row["uniqueId"] = row["unique_id"]
-            new_row["audioPath"] = "https://huggingface.co/datasets/chenjoachim/TAU-dataset/resolve/main/" + row["audio_path"].split('/')[-1]
-            new_row["startMs"] = int(row["start_ms"])
-            new_row["endMs"] = int(row["end_ms"])
-            new_row["question"] = row["question"]
-            # Shuffle the options
-            options = [row["A"], row["B"], row["C"], row["D"]]
-            answer_text = row[row["answer"]]
-            random.shuffle(options)
-            new_row["options"] = options
-            answer_index = options.index(answer_text)
-            new_row["answer"] = chr(ord('A') + answer_index)
-            jsonl_file.write(json.dumps(new_row, ensure_ascii=False) + '\n')
+    df = pd.read_csv(args.input_file, dtype=str, keep_default_na=False, encoding='utf-8')
+
+    # Shuffle the options of all rows at once
+    options = df[OPTION_COLUMNS].to_numpy()
+    answer_orig = df["answer"].map(OPTION_COLUMNS.index).to_numpy(dtype=int)
+    perms = PERMS[np.random.randint(0, len(PERMS), size=len(df))]
+    shuffled = np.take_along_axis(options, perms, axis=1)
+    # The answer moves to wherever its original column landed in the permutation
+    answer_index = (perms == answer_orig[:, None]).argmax(axis=1)
+
+    converted = pd.DataFrame({
+        "type": df["type"],
+        "description": df["description"],
+        "link": df["link"],
+        "uniqueId": df["unique_id"],
+        "audioPath": AUDIO_URL_PREFIX + df["audio_path"].str.rsplit('/', n=1).str[-1],
+        "startMs": df["start_ms"].astype(int),
+        "endMs": df["end_ms"].astype(int),
+        "question": df["question"],
+        "options": shuffled.tolist(),
+        "answer": np.array(OPTION_COLUMNS)[answer_index].tolist(),
+    })
+    write_jsonl(args.output_file, converted.to_dict("records"))
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
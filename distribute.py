@@ -1,7 +1,12 @@
-import json
 import os
 import argparse
 import random
+import heapq
+from contextlib import ExitStack
+
+import orjson
+
+from jsonl_io import dumps_line
 
 ANNOTATORS = ["伊甯", "俞蓁", "家愷", "思齊", "悅媗", "禹融", "紫渝", "致堯", "郁玲"]
 MAX_ENTRIES_PER_ANNOTATOR = 635
@@ -20,31 +25,44 @@ if __name__ == "__main__":
 
     # Equally, randomly distribute entries to annotators
     entries = []
-    with open(args.input_file, 'r', encoding='utf-8') as input_file:
+    with open(args.input_file, 'rb') as input_file:
         for line in input_file:
             if line.strip():
                 try:
-                    entry = json.loads(line)
+                    entry = orjson.loads(line)
                     entries.append(entry)
-                except json.JSONDecodeError:
-                    print(f"Skipping invalid JSON line: {line}")
+                except orjson.JSONDecodeError:
+                    print(f"Skipping invalid JSON line: {line.decode('utf-8', errors='replace')}")
                     continue
 
     random.shuffle(entries)  # Shuffle entries to ensure random distribution
-    annotator_idx = 0
-    entries_per_annotator = {annotator: 0 for annotator in ANNOTATORS}
-    for entry in entries:
-        entry_cnt = 2
-        distributed = {}
-        while entry_cnt > 0:
-            annotator = ANNOTATORS[annotator_idx % len(ANNOTATORS)]
-            if annotator == entry.get("annotator_1", "") or entries_per_annotator[annotator] >= MAX_ENTRIES_PER_ANNOTATOR or distributed.get(annotator, False):
-                annotator_idx += 1
-                continue
-            entries_per_annotator[annotator] += 1
-            distributed[annotator] = True
-            with open(os.path.join(args.output_dir, f"{annotator}.jsonl"), '+a', encoding='utf-8') as f:
-                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
-                
-            annotator_idx += 1
-            entry_cnt -= 1
+    # Min-heap of [assigned count, annotator] so the least loaded annotators are picked first
+    heap = [[0, annotator] for annotator in ANNOTATORS]
+    heapq.heapify(heap)
+    with ExitStack() as stack:
+        # Keep one buffered writer per annotator open for the whole run
+        writers = {
+            annotator: stack.enter_context(
+                open(os.path.join(args.output_dir, f"{annotator}.jsonl"), 'ab', buffering=1 << 20)
+            )
+            for annotator in ANNOTATORS
+        }
+        for entry in entries:
+            line = dumps_line(entry)
+            chosen, skipped = [], []
+            while len(chosen) < 2 and heap:
+                item = heapq.heappop(heap)
+                if item[1] == entry.get("annotator_1", ""):
+                    skipped.append(item)
+                    continue
+                item[0] += 1
+                writers[item[1]].write(line)
+                chosen.append(item)
+            for item in skipped:
+                heapq.heappush(heap, item)
+            for item in chosen:
+                # Annotators at the cap never become eligible again
+                if item[0] < MAX_ENTRIES_PER_ANNOTATOR:
+                    heapq.heappush(heap, item)
+            if len(chosen) < 2:
+                print(f"Not enough annotators below the cap for entry: {entry.get('uniqueId')}")
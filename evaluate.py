@@ -1,15 +1,18 @@
-import json
 import os
 import random
 import time
 from typing import List, Dict, Optional
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tqdm import tqdm
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
+from gemini_utils import AudioFileCache, compute_cost, make_client
+from jsonl_io import read_jsonl, dumps_line
+
 PROMPT_TEMPLATE = """根據音檔，回答以下單選題：
 問題：{question}
 (A) {option_a}
@@ -33,10 +36,19 @@ PRICING = {
         "audio_input": 1e-6,
     },
 }
+# Per-token input prices keyed by prompt modality, for compute_cost
+INPUT_RATES = {
+    model_name: {
+        types.Modality.AUDIO: prices["audio_input"],
+        types.Modality.TEXT: prices["input"],
+    }
+    for model_name, prices in PRICING.items()
+}
 
 
 def evaluate(
     client: genai.Client,
+    audio_files: AudioFileCache,
     row: dict,
     model_name: str,
     max_retries: int = 3,
@@ -52,25 +64,17 @@ def evaluate(
     )
 
     audio_path = os.path.join(AUDIO_DIR, row["audioPath"].split("/")[-1])
-    # Read audio file
-    try:
-        with open(audio_path, "rb") as audio_file:
-            audio_content = audio_file.read()
-    except Exception:
-        return None
+    if not os.path.exists(audio_path):
+        return "", 0.0
 
     # Retry logic for API calls
     for attempt in range(max_retries):
         try:
+            # Questions on the same clip share one uploaded file
+            audio_file = audio_files.get(audio_path)
             response = client.models.generate_content(
                 model=model_name,
-                contents=[
-                    prompt,
-                    types.Part.from_bytes(
-                        data=audio_content,
-                        mime_type="audio/mp3",
-                    ),
-                ],
+                contents=[prompt, audio_file],
                 config=types.GenerateContentConfig(
                     thinking_config=types.ThinkingConfig(
                         thinking_budget=8192,
@@ -84,19 +88,9 @@ def evaluate(
                 ),
             )
             answer = response.text.strip()
-            output_cost = (
-                response.usage_metadata.candidates_token_count
-                + response.usage_metadata.thoughts_token_count
-            ) * PRICING[model_name]["output"]
-            input_cost = 0
-            for modality in response.usage_metadata.prompt_tokens_details:
-                if modality.modality == types.Modality.AUDIO:
-                    input_cost += (
-                        modality.token_count * PRICING[model_name]["audio_input"]
-                    )
-                elif modality.modality == types.Modality.TEXT:
-                    input_cost += modality.token_count * PRICING[model_name]["input"]
-            total_cost = input_cost + output_cost
+            total_cost = compute_cost(
+                response, INPUT_RATES[model_name], PRICING[model_name]["output"]
+            )
 
             if answer:
                 return answer, total_cost
@@ -146,6 +140,12 @@ def parse_args():
         action="store_true",
         help="Whether to use a system prompt to guide the model's responses.",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=16,
+        help="Number of concurrent API requests (default: 16). Entries are written in completion order.",
+    )
     return parser.parse_args()
 
 
@@ -162,25 +162,42 @@ def main():
         print("GEMINI_API_KEY not found in environment variables")
         return
 
-    client = genai.Client(api_key=api_key)
+    # One shared client, pooled for all worker threads
+    client = make_client(api_key, max_connections=args.num_workers)
 
-    data = []
     total_cost = 0.0
 
     # Load input data from JSONL file
-    with open(args.input_file, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip():  # Avoid empty lines
-                data.append(json.loads(line.strip()))
-
-    for entry in tqdm(data, desc="Processing Entries"):
-        answer, cost = evaluate(
-            client, entry, model_name=args.model_name, max_retries=args.max_retries, use_system_prompt=args.use_system_prompt
-        )
-        entry["prediction"] = answer
-        total_cost += cost
-        with open(args.output_file, "+a", encoding="utf-8") as out_f:
-            out_f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    data = list(read_jsonl(args.input_file))
+
+    audio_files = AudioFileCache(client)
+
+    try:
+        # API calls are I/O bound, so keep several in flight and write results as they finish
+        with open(args.output_file, "ab", buffering=1 << 16) as out_f, \
+             ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = {
+                executor.submit(
+                    evaluate,
+                    client,
+                    audio_files,
+                    entry,
+                    model_name=args.model_name,
+                    max_retries=args.max_retries,
+                    use_system_prompt=args.use_system_prompt,
+                ): entry
+                for entry in data
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Entries"):
+                entry = futures[future]
+                answer, cost = future.result()
+                entry["prediction"] = answer
+                total_cost += cost
+                out_f.write(dumps_line(entry))
+                out_f.flush()  # Keep partial results on disk if the run dies
+    finally:
+        # Uploaded audio would otherwise sit in the project's storage until it expires
+        audio_files.delete_all()
 
     print(f"Total cost of API calls: ${total_cost:.6f}")
 
@@ -0,0 +1,427 @@
+import argparse
+import asyncio
+import csv
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Optional
+
+import diskcache
+import httpx
+import orjson
+from google import genai
+from google.genai import types
+from tqdm.asyncio import tqdm
+
+# Batch requests are billed at half the interactive price
+BATCH_DISCOUNT = 0.5
+BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+# Gemini bills audio input at 32 tokens per second
+AUDIO_TOKENS_PER_SECOND = 32
+
+# Uploaded files expire after 48 hours on the Gemini side
+AUDIO_FILE_TTL = 47 * 3600  # seconds
+
+
+def estimate_tokens(prompt: str, audio_ms: int) -> int:
+    """Rough input size of a request: audio tokens plus about one token per prompt character."""
+    return int(audio_ms * AUDIO_TOKENS_PER_SECOND / 1000) + len(prompt)
+
+
+class TokenRateLimiter:
+    """Keep the tokens sent in any rolling window under a tokens-per-minute limit."""
+
+    def __init__(self, tpm_limit: int, window: float = 60.0):
+        self.tpm_limit = tpm_limit
+        self.window = window
+        self._sent = deque()  # (timestamp, tokens) of requests inside the window
+        self._total = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        """Wait until sending `tokens` more keeps the window under the limit."""
+        # A request larger than the whole budget could otherwise never be sent
+        tokens = min(tokens, self.tpm_limit)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0][0] >= self.window:
+                    self._total -= self._sent.popleft()[1]
+                if self._total + tokens <= self.tpm_limit:
+                    self._sent.append((now, tokens))
+                    self._total += tokens
+                    return
+                await asyncio.sleep(self.window - (now - self._sent[0][0]))
+
+
+def compute_cost(
+    response: types.GenerateContentResponse,
+    input_rates: dict[types.Modality, float],
+    output_rate: float,
+) -> float:
+    """Estimate the price of a response; input_rates maps each prompt modality to its per-token price."""
+    usage = response.usage_metadata
+    output_cost = ((usage.candidates_token_count or 0) + (usage.thoughts_token_count or 0)) * output_rate
+    input_cost = sum(
+        detail.token_count * input_rates.get(detail.modality, 0)
+        for detail in usage.prompt_tokens_details
+    )
+    return input_cost + output_cost
+
+
+def make_client(api_key: str, max_connections: int = 64) -> genai.Client:
+    """Create one client whose connection pool can keep every in-flight request alive."""
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            client_args={"limits": limits},
+            async_client_args={"limits": limits},
+        ),
+    )
+
+
+def response_cache_key(model: str, config: types.GenerateContentConfig, audio_content: bytes, prompt: str) -> str:
+    """Key a cached response by model, generation config, audio bytes and prompt text."""
+    config_hash = hashlib.sha256(config.model_dump_json(exclude_none=True).encode()).hexdigest()
+    audio_hash = hashlib.sha256(audio_content).hexdigest()
+    prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+    return f"{model}:{config_hash}:{audio_hash}:{prompt_hash}"
+
+
+def upload_audio_file(client: genai.Client, audio_path: str) -> types.File:
+    """Upload an audio file through the Files API."""
+    return client.files.upload(
+        file=audio_path, config=types.UploadFileConfig(mime_type="audio/mp3")
+    )
+
+
+class AudioFileCache:
+    """Upload each audio file once, shared across threads, and reuse the handle until it nears expiry."""
+
+    def __init__(self, client: genai.Client, ttl: float = AUDIO_FILE_TTL):
+        self.client = client
+        self.ttl = ttl
+        self._files = {}  # audio_path -> (file, uploaded_at)
+        self._uploaded = []  # every file uploaded, including ones replaced after expiry
+        self._lock = threading.Lock()
+        self._path_locks = defaultdict(threading.Lock)
+
+    def get(self, audio_path: str) -> types.File:
+        """Uploaded handle for audio_path, uploading it on first use or once it nears expiry."""
+        with self._lock:
+            path_lock = self._path_locks[audio_path]
+        with path_lock:
+            cached = self._files.get(audio_path)
+            if cached and time.time() - cached[1] < self.ttl:
+                return cached[0]
+            audio_file = upload_audio_file(self.client, audio_path)
+            with self._lock:
+                self._files[audio_path] = (audio_file, time.time())
+                self._uploaded.append(audio_file)
+            return audio_file
+
+    def delete_all(self):
+        """Delete every uploaded file instead of leaving them to expire."""
+        with self._lock:
+            uploaded, self._uploaded = self._uploaded, []
+            self._files.clear()
+        for audio_file in uploaded:
+            try:
+                self.client.files.delete(name=audio_file.name)
+            except Exception as e:
+                print(f"Failed to delete uploaded file {audio_file.name}: {e}")
+
+
+def run_batch(
+    client: genai.Client,
+    model: str,
+    requests: list[types.InlinedRequest],
+    poll_interval: int = 60,
+) -> list[types.GenerateContentResponse | None]:
+    """Submit requests as one inline batch job and wait for it to finish.
+
+    Returns one response per request, in order, or None where a request failed.
+    """
+    if not requests:
+        return []
+    job = client.batches.create(model=model, src=requests)
+    print(f"Submitted batch job {job.name} with {len(requests)} requests")
+    while job.state.name not in BATCH_DONE_STATES:
+        time.sleep(poll_interval)
+        job = client.batches.get(name=job.name)
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {job.name} ended in state {job.state.name}: {job.error}")
+
+    responses = []
+    for inlined in job.dest.inlined_responses:
+        if inlined.error:
+            print(f"Batch request failed: {inlined.error}")
+        responses.append(inlined.response if not inlined.error else None)
+    return responses
+
+
+def add_generation_args(parser: argparse.ArgumentParser):
+    """Add the options shared by the question generation scripts."""
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=3,
+        help="Number of retries for API calls in case of failure (default: 3).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=20,
+        help="Maximum number of API requests in flight (default: 20).",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=8,
+        help="Number of audio files read ahead of the requests in flight (default: 8).",
+    )
+    parser.add_argument(
+        "--prefetch_workers",
+        type=int,
+        default=4,
+        help="Threads reading audio files ahead of the API calls (default: 4).",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit all requests as one Gemini batch job (half price, no retries, may take hours).",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=int,
+        default=60,
+        help="Seconds between batch job status checks (default: 60).",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=".qa_cache",
+        help="Directory of the on-disk response cache. Reruns reuse cached outputs for the same model, config, audio and prompt "
+        "instead of calling the API again (reported as $0); pass --cache_dir \"\" to always regenerate (default: .qa_cache).",
+    )
+    parser.add_argument(
+        "--tpm_limit",
+        type=int,
+        default=0,
+        help="Input tokens per minute to stay under, estimated from audio length; 0 disables (default: 0).",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="Only process the first N input rows (default: all).",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Append to an existing output file, skipping inputs it already covers.",
+    )
+
+
+def read_csv_column(path: str, column: str) -> set[str]:
+    """Distinct values of one column of an existing output CSV, used to resume a run."""
+    with open(path, newline="", encoding="utf-8") as f:
+        return {r[column] for r in csv.DictReader(f)}
+
+
+@functools.lru_cache(maxsize=128)
+def read_audio(audio_path: str) -> bytes:
+    """Read an audio file; run it on a worker thread to keep the event loop free.
+
+    Cached so the same clip is read from disk once per run.
+    """
+    # Read the known size in one syscall rather than growing a buffer
+    fd = os.open(audio_path, os.O_RDONLY)
+    try:
+        return os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+def parse_json_response(response_text: str, validate: Callable[[Any], Any]) -> Optional[Any]:
+    """Parse a JSON response, optionally fenced in ```json, and check it with validate; None if either fails."""
+    try:
+        # Extract JSON from response
+        response_text = response_text.strip()
+        if "```json" in response_text:
+            _, _, rest = response_text.partition("```json")
+            json_content = rest.partition("```")[0].strip()
+        else:
+            json_content = response_text
+
+        parsed = orjson.loads(json_content)
+
+        # Validate response structure
+        validate(parsed)
+        return parsed
+
+    except (orjson.JSONDecodeError, Exception):
+        return None
+
+
+async def generate_for_audio(
+    client: genai.Client,
+    model: str,
+    config: types.GenerateContentConfig,
+    prompt: str,
+    audio_path: str,
+    parse: Callable[[str], Optional[Any]],
+    input_rates: dict[types.Modality, float],
+    output_rate: float,
+    max_retries: int = 3,
+    cache: Optional[diskcache.Cache] = None,
+    rate_limiter: Optional[TokenRateLimiter] = None,
+    audio_ms: int = 0,
+    audio_read: Optional[asyncio.Future] = None,
+) -> tuple[Optional[Any], float]:
+    """Send one prompt with its audio, retrying until parse accepts the response."""
+    # Read audio file
+    try:
+        # Use the prefetched read when the caller started one
+        audio_content = await (audio_read or asyncio.to_thread(read_audio, audio_path))
+    except Exception:
+        return None, 0
+    # Reuse an earlier response for the same model, config, audio and prompt
+    cache_key = response_cache_key(model, config, audio_content, prompt)
+    if cache is not None and cache_key in cache:
+        return cache[cache_key], 0
+    audio_part = types.Part.from_bytes(data=audio_content, mime_type="audio/mp3")
+
+    # Retry logic for API calls
+    for attempt in range(max_retries):
+        try:
+            if rate_limiter is not None:
+                await rate_limiter.acquire(estimate_tokens(prompt, audio_ms))
+            response = await client.aio.models.generate_content(
+                model=model,
+                contents=[prompt, audio_part],
+                config=config,
+            )
+            total_cost = compute_cost(response, input_rates, output_rate)
+            result = parse(response.text)
+            if result:
+                if cache is not None:
+                    cache[cache_key] = result
+                return result, total_cost
+
+        except Exception as e:
+            print(f"Error on attempt {attempt + 1}: {e}")
+            print(f"Attempt {attempt + 1} failed, retrying...")
+            await asyncio.sleep(2**attempt)  # Exponential backoff, e.g. on 429 RESOURCE_EXHAUSTED
+
+    return None, 0
+
+
+async def generate_for_requests(
+    client: genai.Client,
+    requests: list[tuple[Any, str, str, int]],
+    args: argparse.Namespace,
+    model: str,
+    config: types.GenerateContentConfig,
+    parse: Callable[[str], Optional[Any]],
+    input_rates: dict[types.Modality, float],
+    output_rate: float,
+) -> AsyncIterator[tuple[Any, Optional[Any], float]]:
+    """Yield (item, result, cost) for every (item, audio_path, prompt, audio_ms) request as it finishes.
+
+    Identical (audio_path, prompt) requests are sent once; the result is yielded for each of their
+    items and the cost counted on the first. result is None where generation failed. Options come
+    from add_generation_args.
+    """
+    cache = diskcache.Cache(args.cache_dir) if args.cache_dir else None
+
+    # Pace requests by estimated tokens so bursts do not trip the TPM quota
+    rate_limiter = TokenRateLimiter(args.tpm_limit) if args.tpm_limit > 0 else None
+
+    # Identical requests within the run are sent once and their result reused
+    groups = defaultdict(list)
+    unique_requests = []
+    for item, audio_path, prompt, audio_ms in requests:
+        if (audio_path, prompt) not in groups:
+            unique_requests.append((audio_path, prompt, audio_ms))
+        groups[(audio_path, prompt)].append(item)
+    if len(unique_requests) < len(requests):
+        print(f"Merged {len(requests) - len(unique_requests)} duplicate requests")
+
+    # Requests are network bound, so keep up to --concurrency of them in flight
+    semaphore = asyncio.Semaphore(args.concurrency)
+    # Audio for up to --prefetch requests beyond those in flight is read ahead on its own pool
+    prefetch_slots = asyncio.Semaphore(args.concurrency + args.prefetch)
+    prefetch_pool = ThreadPoolExecutor(max_workers=args.prefetch_workers)
+    loop = asyncio.get_running_loop()
+
+    async def bounded(audio_path, prompt, audio_ms):
+        async with prefetch_slots:
+            # Start the disk read before waiting for an API slot so it overlaps in-flight calls
+            audio_read = loop.run_in_executor(prefetch_pool, read_audio, audio_path)
+            async with semaphore:
+                result, cost = await generate_for_audio(
+                    client, model, config, prompt, audio_path, parse, input_rates, output_rate,
+                    max_retries=args.max_retries, cache=cache, rate_limiter=rate_limiter,
+                    audio_ms=audio_ms, audio_read=audio_read,
+                )
+        return audio_path, prompt, result, cost
+
+    async def results():
+        if not args.batch:
+            tasks = [bounded(*request) for request in unique_requests]
+            for task in tqdm.as_completed(tasks, total=len(tasks), desc="Processing Rows"):
+                yield await task
+            return
+
+        # Batch mode: audio goes through the Files API since inline requests are size limited
+        audio_files = AudioFileCache(client)
+        try:
+            batch_keys, batch_requests = [], []
+            for audio_path, prompt, _ in tqdm(unique_requests, desc="Uploading Audio"):
+                try:
+                    cache_key = response_cache_key(model, config, read_audio(audio_path), prompt)
+                    if cache is not None and cache_key in cache:
+                        yield audio_path, prompt, cache[cache_key], 0
+                        continue
+                    audio_file = audio_files.get(audio_path)
+                except Exception as e:
+                    print(f"Failed to upload {audio_path}: {e}")
+                    yield audio_path, prompt, None, 0
+                    continue
+                batch_keys.append((audio_path, prompt, cache_key))
+                batch_requests.append(types.InlinedRequest(
+                    contents=[prompt, types.Part.from_uri(file_uri=audio_file.uri, mime_type=audio_file.mime_type)],
+                    config=config,
+                ))
+            responses = await asyncio.to_thread(run_batch, client, model, batch_requests, args.poll_interval)
+        finally:
+            # The batch job has read the audio by the time it finishes
+            audio_files.delete_all()
+        for (audio_path, prompt, cache_key), response in zip(batch_keys, responses):
+            if response is None:
+                yield audio_path, prompt, None, 0
+                continue
+            result = parse(response.text)
+            if result and cache is not None:
+                cache[cache_key] = result
+            yield audio_path, prompt, result, compute_cost(response, input_rates, output_rate) * BATCH_DISCOUNT
+
+    try:
+        async for audio_path, prompt, result, cost in results():
+            for item in groups[(audio_path, prompt)]:
+                yield item, result, cost
+                cost = 0  # Charged once per request, not per duplicate
+    finally:
+        prefetch_pool.shutdown(wait=False)
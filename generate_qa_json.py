@@ -1,16 +1,25 @@
-import json
+import asyncio
+import csv
 import os
 from typing import List, Dict, Optional
 import argparse
-import random
+from itertools import islice
 import uuid
 
-import pandas as pd
-from tqdm import tqdm
+import fastjsonschema
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
+from gemini_utils import (
+    add_generation_args,
+    generate_for_requests,
+    make_client,
+    parse_json_response,
+    read_csv_column,
+)
+from jsonl_io import read_jsonl
+
 # Prompt template for generating questions
 QUESTION_PER_AUDIO = 3
 PROMPT_TEMPLATE = f"""請為音檔和對應的描述「%s」生成 {QUESTION_PER_AUDIO} 道測試題，測試使用者能否從音檔中推斷出對應的描述。
@@ -45,100 +54,39 @@ JSON 格式：
 INPUT_COST = 0.3e-6
 AUDIO_COST = 1.0e-6
 OUTPUT_COST = 2.5e-6
+INPUT_RATES = {types.Modality.AUDIO: AUDIO_COST, types.Modality.TEXT: INPUT_COST}
 
-
-def parse_json_response(response_text: str) -> Optional[List[Dict]]:
-    """Parse and validate JSON response from the API."""
-    try:
-        # Extract JSON from response
-        if "```json" in response_text:
-            json_content = (
-                response_text.strip()
-                .split("```json")[1]
-                .strip()
-                .split("```")[0]
-                .strip()
-            )
-        else:
-            json_content = response_text.strip()
-
-        questions = json.loads(json_content)
-
-        # Validate response structure
-        if not isinstance(questions, list) or len(questions) != QUESTION_PER_AUDIO:
-            return None
-
-        # Validate each question format
-        for question in questions:
-            required_keys = ["question", "options", "answer"]
-            if not all(key in question for key in required_keys):
-                return None
-
-            if not isinstance(question["options"], dict):
-                return None
-
-            if set(question["options"].keys()) != {"A", "B", "C", "D"}:
-                return None
-
-            if question["answer"] not in ["A", "B", "C", "D"]:
-                return None
-
-        return questions
-
-    except (json.JSONDecodeError, Exception):
-        return None
-
-
-def generate_questions_for_audio(
-    client: genai.Client, audio_path: str, description: str, max_retries: int = 3
-) -> tuple[Optional[List[Dict]], float]:
-    """Generate questions for a single audio file with retry logic."""
-    prompt = PROMPT_TEMPLATE % (description.strip())
-    # Read audio file
-    try:
-        with open(audio_path, "rb") as audio_file:
-            audio_content = audio_file.read()
-    except Exception:
-        return None
-
-    # Retry logic for API calls
-    for attempt in range(max_retries):
-        try:
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=[
-                    prompt,
-                    types.Part.from_bytes(
-                        data=audio_content,
-                        mime_type="audio/mp3",
-                    ),
-                ],
-                config=types.GenerateContentConfig(
-                    thinking_config=types.ThinkingConfig(
-                        thinking_budget=8192,
-                    )
-                ),
-            )
-            output_cost = (
-                response.usage_metadata.candidates_token_count
-                + response.usage_metadata.thoughts_token_count
-            ) * OUTPUT_COST
-            input_cost = 0
-            for modality in response.usage_metadata.prompt_tokens_details:
-                if modality.modality == types.Modality.AUDIO:
-                    input_cost += modality.token_count * AUDIO_COST
-                elif modality.modality == types.Modality.TEXT:
-                    input_cost += modality.token_count * INPUT_COST
-            total_cost = input_cost + output_cost
-            questions = parse_json_response(response.text)
-            if questions:
-                return questions, total_cost
-
-        except Exception as e:
-            print(f"Error on attempt {attempt + 1}: {e}")
-            print(f"Attempt {attempt + 1} failed, retrying...")
-
-    return None, 0
+MODEL_NAME = "gemini-2.5-flash"
+GENERATION_CONFIG = types.GenerateContentConfig(
+    thinking_config=types.ThinkingConfig(
+        thinking_budget=8192,
+    )
+)
+
+# Compiled once; raises fastjsonschema.JsonSchemaException on an invalid response
+QUESTION_SCHEMA = {
+    "type": "array",
+    "minItems": QUESTION_PER_AUDIO,
+    "maxItems": QUESTION_PER_AUDIO,
+    "items": {
+        "type": "object",
+        "required": ["question", "options", "answer"],
+        "properties": {
+            "options": {
+                "type": "object",
+                "required": ["A", "B", "C", "D"],
+                "propertyNames": {"enum": ["A", "B", "C", "D"]},
+            },
+            "answer": {"enum": ["A", "B", "C", "D"]},
+        },
+    },
+}
+validate_questions = fastjsonschema.compile(QUESTION_SCHEMA)
+
+
+def parse_questions(response_text: str) -> Optional[List[Dict]]:
+    """Parse and validate the questions in a response from the API."""
+    return parse_json_response(response_text, validate_questions)
 
 
 def parse_args():
@@ -158,16 +106,11 @@ def parse_args():
         required=True,
         help="Path to the output CSV file where processed audio data will be saved.",
     )
-    parser.add_argument(
-        "--max_retries",
-        type=int,
-        default=3,
-        help="Number of retries for API calls in case of failure (default: 3).",
-    )
+    add_generation_args(parser)
     return parser.parse_args()
 
 
-def main():
+async def main():
     """Main function to process audio files and generate questions."""
     args = parse_args()
     print("Starting question generation process...")
@@ -180,51 +123,64 @@ def main():
         print("GEMINI_API_KEY not found in environment variables")
         return
 
-    client = genai.Client(api_key=api_key)
+    # One shared client, pooled for all concurrent requests
+    client = make_client(api_key, max_connections=args.concurrency)
 
     # Load input data
-    with open(args.input_file, "r", encoding='utf-8') as f:
-        data = [json.loads(line) for line in f]
+    data = list(islice(read_jsonl(args.input_file), args.limit))
 
     print(f"Loaded {len(data)} audio files from {args.input_file}")
 
-    # Initialize output DataFrame
+    # unique_id is random here, so skip clips whose audio_path is already in the output
+    resuming = args.resume and os.path.exists(args.output_file)
+    done_paths = set()
+    if resuming:
+        done_paths = read_csv_column(args.output_file, "audio_path")
+        print(f"Resuming: skipping {len(done_paths)} audio files already in {args.output_file}")
+
     output_columns = ["type", "description", "link", "unique_id", "audio_path", "start_ms", "end_ms", "question", "A", "B", "C", "D", "answer"]
-    processed_df = pd.DataFrame(columns=output_columns)
 
     successful_count = 0
     total_questions = 0
 
     total_cost = 0.0
 
-    for index, row in enumerate(tqdm(data, total=len(data), desc="Processing Rows")):
-        for audio_idx in range(len(row["audio"])):
-            questions, cost = generate_questions_for_audio(
-                client, row["audio"][audio_idx]["audio_path"], row["description"], max_retries=args.max_retries
-            )
+    requests = [
+        (audio | {"type": row["type"], "description": row["description"]},
+         audio["audio_path"], PROMPT_TEMPLATE % (row["description"].strip()), audio["end_ms"] - audio["start_ms"])
+        for row in data
+        for audio in row["audio"]
+        if audio["audio_path"] not in done_paths
+    ]
+    results = generate_for_requests(
+        client, requests, args, MODEL_NAME, GENERATION_CONFIG, parse_questions, INPUT_RATES, OUTPUT_COST
+    )
 
+    # Write each row as soon as it is generated so a crash keeps finished work
+    with open(args.output_file, "a" if resuming else "w", newline="", encoding="utf-8") as out_f:
+        writer = csv.DictWriter(out_f, fieldnames=output_columns)
+        if not resuming:
+            writer.writeheader()
+        async for clip, questions, cost in results:
             if questions:
                 # Create new rows for each question
-                for idx, question_data in enumerate(questions):
-                    new_row = {}
-                    new_row["type"] = row["type"]
-                    new_row["description"] = row["description"]
-                    new_row["link"] = row["audio"][audio_idx]["link"]
-                    new_row["audio_path"] = row["audio"][audio_idx]["audio_path"]
-                    new_row["start_ms"] = row["audio"][audio_idx]["start_ms"]
-                    new_row["end_ms"] = row["audio"][audio_idx]["end_ms"]
-                    
-                    
-                    new_row["unique_id"] = uuid.uuid4().hex[:8].upper()
-                    new_row["question"] = question_data["question"]
-                    new_row["A"] = question_data["options"]["A"]
-                    new_row["B"] = question_data["options"]["B"]
-                    new_row["C"] = question_data["options"]["C"]
-                    new_row["D"] = question_data["options"]["D"]
-                    new_row["answer"] = question_data["answer"]
-                    processed_df = pd.concat(
-                        [processed_df, pd.DataFrame([new_row])], ignore_index=True
-                    )
+                row_dict = {
+                    "type": clip["type"],
+                    "description": clip["description"],
+                    "link": clip["link"],
+                    "audio_path": clip["audio_path"],
+                    "start_ms": clip["start_ms"],
+                    "end_ms": clip["end_ms"],
+                }
+                for question_data in questions:
+                    writer.writerow({
+                        **row_dict,
+                        "unique_id": uuid.uuid4().hex[:8].upper(),
+                        "question": question_data["question"],
+                        **question_data["options"],
+                        "answer": question_data["answer"],
+                    })
+                out_f.flush()
 
                 successful_count += 1
                 total_questions += len(questions)
@@ -234,20 +190,13 @@ def main():
 
             total_cost += cost
 
-        # break
-
-    # Save results
-    try:
-        processed_df.to_csv(args.output_file, index=False)
-        print(
-            f"Generated {total_questions} questions from {successful_count} audio files"
-        )
-        print(f"Results saved to {args.output_file}")
-    except Exception as e:
-        print(f"Failed to save results: {e}")
+    print(
+        f"Generated {total_questions} questions from {successful_count} audio files"
+    )
+    print(f"Results saved to {args.output_file}")
 
     print(f"Total API cost: ${total_cost:.6f}")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
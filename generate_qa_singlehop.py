@@ -1,17 +1,25 @@
 import csv
-import json
+import asyncio
 import os
 from typing import List, Dict, Optional
 import argparse
-import random
+from itertools import islice
 import uuid
 
-import pandas as pd
-from tqdm import tqdm
+import fastjsonschema
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
+from gemini_utils import (
+    add_generation_args,
+    generate_for_requests,
+    make_client,
+    parse_json_response,
+    read_csv_column,
+)
+from jsonl_io import read_jsonl
+
 # Prompt template for generating question
 # PROMPT_TEMPLATE = f"""根據音檔的聲音特徵、音檔描述「%s」和原始問題「%s」，請：
 
@@ -37,7 +45,7 @@ from google.genai import types
 # 生成一道問題：
 # """
 
-PROMPT_TEMPLATE = f"""根據音檔的聲音特徵、音檔描述「%s」和原始問題「%s」，請：
+PROMPT_TEMPLATE = """根據音檔的聲音特徵、音檔描述「{desc}」和原始問題「{cq}」，請：
 
 1. 將原始問題換句話說 (保持原意不變）
 2. 提供正確答案和3個合理的混淆項
@@ -65,11 +73,11 @@ PROMPT_TEMPLATE = f"""根據音檔的聲音特徵、音檔描述「%s」和原
 - 如發現虛構資訊，請重新設計該干擾項並再次驗證
 
 JSON 格式：
-{{
+{
   "question": "[問題文字]",
-  "options": {{"A": "[選項A]", "B": "[選項B]", "C": "[選項C]", "D": "[選項D]"}},
+  "options": {"A": "[選項A]", "B": "[選項B]", "C": "[選項C]", "D": "[選項D]"},
   "answer": "[字母]"
-}}
+}
 
 生成一道問題"""
 
@@ -86,106 +94,46 @@ CRAFTED_QUESTION = {
     "Entertainment": "這首曲子是什麼歌曲或音樂？"
 }
 
+# The crafted question only depends on the class, so fill it in once per class
+CLASS_PROMPT = {
+    audio_class: PROMPT_TEMPLATE.replace("{cq}", question)
+    for audio_class, question in CRAFTED_QUESTION.items()
+}
+
 INPUT_COST = 0.3e-6
 AUDIO_COST = 1.0e-6
 OUTPUT_COST = 2.5e-6
+INPUT_RATES = {types.Modality.AUDIO: AUDIO_COST, types.Modality.TEXT: INPUT_COST}
+
+MODEL_NAME = "gemini-2.5-flash"
+GENERATION_CONFIG = types.GenerateContentConfig(
+    thinking_config=types.ThinkingConfig(
+        thinking_budget=8192,
+    ),
+    tools=[
+        types.Tool(google_search=types.GoogleSearch())
+    ]
+)
+
+# Compiled once; raises fastjsonschema.JsonSchemaException on an invalid response
+QUESTION_SCHEMA = {
+    "type": "object",
+    "required": ["question", "options", "answer"],
+    "properties": {
+        "options": {
+            "type": "object",
+            "required": ["A", "B", "C", "D"],
+            "propertyNames": {"enum": ["A", "B", "C", "D"]},
+        },
+        "answer": {"enum": ["A", "B", "C", "D"]},
+    },
+}
+validate_question = fastjsonschema.compile(QUESTION_SCHEMA)
 
 
-def parse_json_response(response_text: str) -> Optional[List[Dict]]:
-    """Parse and validate JSON response from the API."""
-    try:
-        # Extract JSON from response
-        if "```json" in response_text:
-            json_content = (
-                response_text.strip()
-                .split("```json")[1]
-                .strip()
-                .split("```")[0]
-                .strip()
-            )
-        else:
-            json_content = response_text.strip()
-
-        question = json.loads(json_content)
-
-        # Validate response structure
-        if not isinstance(question, dict):
-            return None
-
-        # Validate each question format
-        required_keys = ["question", "options", "answer"]
-        if not all(key in question for key in required_keys):
-            return None
-
-        if not isinstance(question["options"], dict):
-            return None
-
-        if set(question["options"].keys()) != {"A", "B", "C", "D"}:
-            return None
-
-        if question["answer"] not in ["A", "B", "C", "D"]:
-            return None
-
-        return question
-
-    except (json.JSONDecodeError, Exception):
-        return None
-
-
-def generate_question_for_audio(
-    client: genai.Client, audio_path: str, description: str, audio_class: str, max_retries: int = 3
-) -> tuple[Optional[List[Dict]], float]:
-    """Generate question for a single audio file with retry logic."""
-    prompt = PROMPT_TEMPLATE % (description.strip(), CRAFTED_QUESTION[audio_class])
-
-    # Read audio file
-    try:
-        with open(audio_path, "rb") as audio_file:
-            audio_content = audio_file.read()
-    except Exception:
-        return None
-
-    # Retry logic for API calls
-    for attempt in range(max_retries):
-        try:
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=[
-                    prompt,
-                    types.Part.from_bytes(
-                        data=audio_content,
-                        mime_type="audio/mp3",
-                    ),
-                ],
-                config=types.GenerateContentConfig(
-                    thinking_config=types.ThinkingConfig(
-                        thinking_budget=8192,
-                    ),
-                    tools=[
-                        types.Tool(google_search=types.GoogleSearch())
-                    ]
-                ),
-            )
-            output_cost = (
-                response.usage_metadata.candidates_token_count
-                + response.usage_metadata.thoughts_token_count
-            ) * OUTPUT_COST
-            input_cost = 0
-            for modality in response.usage_metadata.prompt_tokens_details:
-                if modality.modality == types.Modality.AUDIO:
-                    input_cost += modality.token_count * AUDIO_COST
-                elif modality.modality == types.Modality.TEXT:
-                    input_cost += modality.token_count * INPUT_COST
-            total_cost = input_cost + output_cost
-            question = parse_json_response(response.text)
-            if question:
-                return question, total_cost
-
-        except Exception as e:
-            print(f"Error on attempt {attempt + 1}: {e}")
-            print(f"Attempt {attempt + 1} failed, retrying...")
-
-    return None, 0
+def parse_question(response_text: str) -> Optional[Dict]:
+    """Parse and validate the question in a response from the API."""
+    return parse_json_response(response_text, validate_question)
 
 
 def parse_args():
@@ -205,16 +153,11 @@ def parse_args():
         required=True,
         help="Path to the output CSV file where processed audio data will be saved.",
     )
-    parser.add_argument(
-        "--max_retries",
-        type=int,
-        default=3,
-        help="Number of retries for API calls in case of failure (default: 3).",
-    )
+    add_generation_args(parser)
     return parser.parse_args()
 
 
-def main():
+async def main():
     """Main function to process audio files and generate question."""
     args = parse_args()
     print("Starting question generation process...")
@@ -227,56 +170,60 @@ def main():
         print("GEMINI_API_KEY not found in environment variables")
         return
 
-    client = genai.Client(api_key=api_key)
+    # One shared client, pooled for all concurrent requests
+    client = make_client(api_key, max_connections=args.concurrency)
 
     # Load input data
-    with open(args.input_file, "r", encoding='utf-8') as f:
-        data = [json.loads(line) for line in f]
+    data = list(islice(read_jsonl(args.input_file), args.limit))
 
     print(f"Loaded {len(data)} audio files from {args.input_file}")
 
-    # Initialize output DataFrame
+    # unique_id is random here, so skip clips whose audio_path is already in the output
+    resuming = args.resume and os.path.exists(args.output_file)
+    done_paths = set()
+    if resuming:
+        done_paths = read_csv_column(args.output_file, "audio_path")
+        print(f"Resuming: skipping {len(done_paths)} audio files already in {args.output_file}")
+
     output_columns = ["type", "description", "link", "unique_id", "audio_path", "start_ms", "end_ms", "question", "A", "B", "C", "D", "answer"]
-    
-    # Write to output CSV
-    with open(args.output_file, "w", encoding='utf-8') as f:
-        f.write(",".join(output_columns) + "\n")
 
     successful_count = 0
     total_question = 0
 
     total_cost = 0.0
 
-    for index, row in enumerate(tqdm(data, total=len(data), desc="Processing Rows")):
-        for audio_idx in range(len(row["audio"])):
-            question, cost = generate_question_for_audio(
-                client, row["audio"][audio_idx]["audio_path"], row["description"], audio_class=row["type"], max_retries=args.max_retries
-            )
+    requests = [
+        (audio | {"type": row["type"], "description": row["description"]},
+         audio["audio_path"], CLASS_PROMPT[row["type"]].replace("{desc}", row["description"].strip()),
+         audio["end_ms"] - audio["start_ms"])
+        for row in data
+        for audio in row["audio"]
+        if audio["audio_path"] not in done_paths
+    ]
+    results = generate_for_requests(
+        client, requests, args, MODEL_NAME, GENERATION_CONFIG, parse_question, INPUT_RATES, OUTPUT_COST
+    )
 
+    # Rows are appended as soon as their request finishes, in completion order
+    with open(args.output_file, "a" if resuming else "w", newline="", encoding="utf-8") as out_f:
+        writer = csv.DictWriter(out_f, fieldnames=output_columns)
+        if not resuming:
+            writer.writeheader()
+        async for clip, question, cost in results:
             if question:
-                # Create new rows for each question
-                new_row = {}
-                new_row["type"] = row["type"]
-                new_row["description"] = row["description"]
-                new_row["link"] = row["audio"][audio_idx]["link"]
-                new_row["audio_path"] = row["audio"][audio_idx]["audio_path"]
-                new_row["start_ms"] = row["audio"][audio_idx]["start_ms"]
-                new_row["end_ms"] = row["audio"][audio_idx]["end_ms"]
-                
-                
-                new_row["unique_id"] = uuid.uuid4().hex[:8].upper()
-                new_row["question"] = question["question"]
-                new_row["A"] = question["options"]["A"]
-                new_row["B"] = question["options"]["B"]
-                new_row["C"] = question["options"]["C"]
-                new_row["D"] = question["options"]["D"]
-                new_row["answer"] = question["answer"]
-                
-                # Append new row 
-                with open(args.output_file, "a", encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    new_row_data = [new_row[col] for col in output_columns]
-                    writer.writerow(new_row_data)
+                writer.writerow({
+                    "type": clip["type"],
+                    "description": clip["description"],
+                    "link": clip["link"],
+                    "audio_path": clip["audio_path"],
+                    "start_ms": clip["start_ms"],
+                    "end_ms": clip["end_ms"],
+                    "unique_id": uuid.uuid4().hex[:8].upper(),
+                    "question": question["question"],
+                    **question["options"],
+                    "answer": question["answer"],
+                })
+                out_f.flush()
 
                 successful_count += 1
                 total_question += 1
@@ -285,7 +232,6 @@ def main():
 
             total_cost += cost
 
-
     # Save results
     print(
         f"Generated {total_question} question from {successful_count} audio files"
@@ -296,4 +242,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import tempfile
+
+import orjson
+
+DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+
+
+def dumps_line(row) -> bytes:
+    """Serialize a row to a newline-terminated JSONL record."""
+    return orjson.dumps(row, option=DUMPS_OPTIONS)
+
+
+def read_jsonl(path):
+    """Yield the parsed rows of a JSONL file, skipping blank lines."""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
+
+def write_jsonl(path, rows, mode="wb"):
+    """Write rows to a JSONL file (use mode="ab" to append)."""
+    with open(path, mode) as f:
+        for row in rows:
+            f.write(dumps_line(row))
+
+
+def external_sort(pairs):
+    """Yield (key, row) pairs ordered by key, spilling to disk.
+
+    Rows are written to a temporary file and ordered with the system `sort`,
+    so memory use does not grow with the input. Keys must not contain tabs or
+    newlines; rows with equal keys keep their input order.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spill_path = os.path.join(tmp_dir, "rows.tsv")
+        with open(spill_path, "wb") as f:
+            for key, row in pairs:
+                f.write(f"{key}\t".encode() + orjson.dumps(row) + b"\n")
+
+        proc = subprocess.Popen(
+            ["sort", "-s", "-t", "\t", "-k1,1", "-T", tmp_dir, spill_path],
+            stdout=subprocess.PIPE,
+            env={**os.environ, "LC_ALL": "C"},
+        )
+        with proc.stdout:
+            for line in proc.stdout:
+                key, _, payload = line.partition(b"\t")
+                yield key.decode(), orjson.loads(payload)
+        if proc.wait() != 0:
+            raise RuntimeError(f"sort exited with status {proc.returncode}")
+
+
+def merge_join(rows, others):
+    """Pair each (key, row) with the last (key, other) sharing its key.
+
+    Both inputs must be sorted by key (see external_sort). Yields
+    (row, other) tuples, with other set to None when there is no match.
+    """
+    others = iter(others)
+    pending = next(others, None)
+    last_key, last_match = None, None
+    for key, row in rows:
+        if key != last_key:
+            last_key, last_match = key, None
+            while pending is not None and pending[0] <= key:
+                if pending[0] == key:
+                    last_match = pending[1]
+                pending = next(others, None)
+        yield row, last_match
@@ -1,7 +1,8 @@
 import os
-import json
 import argparse
-from collections import Counter
+from contextlib import ExitStack
+
+import orjson
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Delete too easy entries from a JSONL file.")
@@ -15,34 +16,44 @@ def parse_args():
 if __name__ == "__main__":
     args = parse_args()
 
-    with open(args.llama_inference, "r", encoding='utf-8') as f:
-        llama_inference = [json.loads(line) for line in f]
-
-    with open(args.input_file, "r", encoding='utf-8') as f:
-        input_data = [json.loads(line) for line in f]
-
-    print(f"Loaded {len(input_data)} entries from {args.input_file}")
-    
-    correct_count = Counter()
-    for entry in llama_inference:
-        if entry["correct"]:
-            correct_count[entry["uniqueId"]] += 1
-
-    # Filter entries that are too easy (correct count >= 4)
-    too_easy_ids = {id for id, count in correct_count.items() if count >= 4}
-
-    # Write the filtered entries to the output file
-    with open(args.output_file, "w", encoding='utf-8') as f:
-        for entry in input_data:
-            if entry["uniqueId"] not in too_easy_ids:
-                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-
-    print(f"Filtered data written to {args.output_file}. Total entries: {len(input_data) - len(too_easy_ids)}")
-
-    if args.deleted_file:
-        with open(args.deleted_file, "w", encoding='utf-8') as f:
-            for entry in input_data:
-                if entry["uniqueId"] in too_easy_ids:
-                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-
-    print(f"Deleted entries written to {args.deleted_file}. Total deleted: {len(too_easy_ids)}")
\ No newline at end of file
+    # Entries answered correctly at least this many times are too easy
+    min_correct = 4
+
+    # Count correct answers per entry; an id stops being counted once it is too easy
+    correct_count = {}
+    too_easy_ids = set()
+    with open(args.llama_inference, "rb") as f:
+        for line in f:
+            entry = orjson.loads(line)
+            unique_id = entry["uniqueId"]
+            if not entry["correct"] or unique_id in too_easy_ids:
+                continue
+            count = correct_count.get(unique_id, 0) + 1
+            if count >= min_correct:
+                too_easy_ids.add(unique_id)
+                del correct_count[unique_id]
+            else:
+                correct_count[unique_id] = count
+
+    # Split the input in one pass, copying each line through unchanged
+    num_kept, num_deleted = 0, 0
+    with ExitStack() as stack:
+        input_file = stack.enter_context(open(args.input_file, "rb"))
+        output_file = stack.enter_context(open(args.output_file, "wb", buffering=1 << 20))
+        deleted_file = stack.enter_context(open(args.deleted_file, "wb", buffering=1 << 20)) if args.deleted_file else None
+        for line in input_file:
+            if not line.strip():
+                continue
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            if orjson.loads(line)["uniqueId"] not in too_easy_ids:
+                output_file.write(line)
+                num_kept += 1
+            else:
+                if deleted_file:
+                    deleted_file.write(line)
+                num_deleted += 1
+
+    print(f"Loaded {num_kept + num_deleted} entries from {args.input_file}")
+    print(f"Filtered data written to {args.output_file}. Total entries: {num_kept}")
+    print(f"Deleted entries written to {args.deleted_file}. Total deleted: {num_deleted}")
@@ -1,6 +1,7 @@
-import json
 import argparse
-import copy
+from itertools import islice
+
+import orjson
 
 from transformers import AutoTokenizer
 from vllm import LLM, SamplingParams
@@ -10,39 +11,57 @@ def parse_args():
     parser.add_argument("--model", type=str, default="meta-llama/Llama-3.2-3B-Instruct", help="Pre-trained model ID.")
     parser.add_argument("-i", "--input_file", type=str, required=False, help="Path to the input file containing prompts.")
     parser.add_argument("-o", "--output_file", type=str, required=False, help="Path to the output file to save generated texts.")
-    parser.add_argument("--batch_size", type=int, default=8, help="Batch size for processing.")
-    parser.add_argument("--gpu_memory_utilization", type=float, default=0.75, help="GPU memory utilization.")
+    parser.add_argument("--batch_size", type=int, default=256, help="Maximum number of sequences vLLM runs concurrently.")
+    parser.add_argument("--gpu_memory_utilization", type=float, default=0.92, help="GPU memory utilization.")
+    parser.add_argument("--max_model_len", type=int, default=768, help="Maximum prompt plus completion length in tokens.")
+    parser.add_argument("--max_num_batched_tokens", type=int, default=8192, help="Maximum tokens scheduled per engine step.")
+    parser.add_argument("--kv_cache_dtype", type=str, default="fp8", help="KV cache dtype; use 'auto' to keep the model dtype.")
     parser.add_argument("--transcript_file", type=str, default="", help="Path to the transcript file.")
+    parser.add_argument("--chunk_size", type=int, default=4096, help="Number of input items read and generated at a time.")
     return parser.parse_args()
 
+
+def read_items(path, prompt_template, transcripts=None):
+    """Yield input items with their user prompt filled in, using transcripts by audioPath when given."""
+    with open(path, "rb") as f:
+        for line in f:
+            item = orjson.loads(line)
+            transcript = item["transcription"] if transcripts is None else transcripts.get(item["audioPath"], "")
+            item["prompt"] = prompt_template.format(
+                transcript=transcript,
+                question=item["question"],
+                option_a=item["options"][0],
+                option_b=item["options"][1],
+                option_c=item["options"][2],
+                option_d=item["options"][3]
+            )
+            yield item
+
 if __name__ == "__main__":
     args = parse_args()
 
+    # Capture CUDA graphs for every power-of-two batch up to max_num_seqs so decode steps never fall back to eager
+    cudagraph_capture_sizes = [1 << i for i in range(args.batch_size.bit_length()) if 1 << i < args.batch_size]
+    cudagraph_capture_sizes.append(args.batch_size)
+
     # Initialize model
     llm = LLM(
         model=args.model,
         gpu_memory_utilization=args.gpu_memory_utilization,
         trust_remote_code=True,
         dtype="bfloat16",
-        max_model_len=2048,
+        kv_cache_dtype=args.kv_cache_dtype,
+        max_model_len=args.max_model_len,
         max_num_seqs=args.batch_size,
+        max_num_batched_tokens=args.max_num_batched_tokens,
+        # Every prompt starts with the same system message and template prefix
+        enable_prefix_caching=True,
+        enforce_eager=False,
+        compilation_config={"cudagraph_capture_sizes": cudagraph_capture_sizes},
     )
 
     tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=False)
 
-    # Define sampling parameters
-    sampling_params = SamplingParams(
-        temperature=0.8,
-        top_p=0.95,
-        max_tokens=192
-    )
-    
-    data = []
-
-    with open(args.input_file, "r", encoding="utf-8") as f:
-        for line in f:
-            data.append(json.loads(line.strip()))
-
     PROMPT_TEMPLATE = """音檔的逐字稿：「{transcript}」
 根據此逐字稿，回答以下單選題：
 問題：{question}
@@ -55,58 +74,59 @@ if __name__ == "__main__":
 
     SYSTEM_PROMPT = "You are a Taiwanese person. Always respond with the perspective, cultural background, and knowledge of someone from Taiwan."
     REPEATS = 1
-    # Batch prompts
-    if not args.transcript_file:
-        for item in data:
-            item["prompt"] = PROMPT_TEMPLATE.format(
-                transcript=item["transcription"],
-                question=item["question"],
-                option_a=item["options"][0],
-                option_b=item["options"][1],
-                option_c=item["options"][2],
-                option_d=item["options"][3]
-            )
-    else:
-        transcripts = {}
-        with open(args.transcript_file, "r", encoding="utf-8") as f:
-            for line in f:
-                entry = json.loads(line.strip())
-                transcripts[entry["audioPath"]] = entry["transcription"]
-        
-        for item in data:
-            transcript = transcripts.get(item["audioPath"], "")
-            item["prompt"] = PROMPT_TEMPLATE.format(
-                transcript=transcript,
-                question=item["question"],
-                option_a=item["options"][0],
-                option_b=item["options"][1],
-                option_c=item["options"][2],
-                option_d=item["options"][3]
-            )
-    
-    # Copy data 5 times
-    new_data = []
 
-    for item in data:
-        for _ in range(REPEATS):
-            new_data.append(copy.deepcopy(item))
+    # Define sampling parameters; each prompt is prefilled once and sampled REPEATS times
+    sampling_params = SamplingParams(
+        temperature=0.8,
+        top_p=0.95,
+        max_tokens=192,
+        n=REPEATS,
+    )
+
+    transcripts = None
+    if args.transcript_file:
+        with open(args.transcript_file, "rb") as f:
+            transcripts = {entry["audioPath"]: entry["transcription"] for entry in map(orjson.loads, f)}
 
-    data = new_data
+    def chat_messages(user_content):
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_content}
+        ]
 
-    # Apply chat template
-    prompts = [
-        tokenizer.apply_chat_template([
-            {"role": "system", "content": SYSTEM_PROMPT}, 
-            {"role": "user", "content": item["prompt"]}
-        ], add_generation_prompt=True, tokenize=False) for item in data
-    ]
+    # Render the chat template once around a placeholder; only the user turn differs between prompts
+    placeholder = "<<USER_CONTENT>>"
+    template = tokenizer.apply_chat_template(chat_messages(placeholder), add_generation_prompt=True, tokenize=False)
+    prefix, suffix = template.split(placeholder)
+    prefix_ids = tokenizer(prefix, add_special_tokens=False).input_ids
+    suffix_ids = tokenizer(suffix, add_special_tokens=False).input_ids
 
-    # Generate responses
-    outputs = llm.generate(prompts, sampling_params)
+    # Stream the input in chunks so memory stays bounded by chunk_size rather than the dataset
+    items = read_items(args.input_file, PROMPT_TEMPLATE, transcripts)
+    checked_template = False
+    with open(args.output_file, "wb", buffering=1 << 20) as f:
+        while chunk := list(islice(items, args.chunk_size)):
+            # The chat template trims the user content, so strip it the same way before splicing
+            user_ids = tokenizer([item["prompt"].strip() for item in chunk], add_special_tokens=False).input_ids
+            prompts = [{"prompt_token_ids": prefix_ids + ids + suffix_ids} for ids in user_ids]
 
-    for item, output in zip(data, outputs):
-        item["prediction"] = output.outputs[0].text.strip()
+            if not checked_template:
+                expected_ids = tokenizer.apply_chat_template(
+                    chat_messages(chunk[0]["prompt"]), add_generation_prompt=True, tokenize=True
+                )
+                # A real check rather than an assert, so it still runs under python -O
+                if prompts[0]["prompt_token_ids"] != list(expected_ids):
+                    raise ValueError(
+                        "Spliced prompt tokens differ from apply_chat_template; this chat template cannot be split around the user turn"
+                    )
+                checked_template = True
 
-    with open(args.output_file, "w", encoding="utf-8") as f:
-        for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            # Generate responses
+            outputs = llm.generate(prompts, sampling_params)
+
+            # Fan each prompt's samples back out into one entry per repeat
+            f.writelines(
+                orjson.dumps({**item, "prediction": sample.text.strip()}, option=orjson.OPT_APPEND_NEWLINE)
+                for item, output in zip(chunk, outputs)
+                for sample in output.outputs
+            )
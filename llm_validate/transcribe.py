@@ -1,10 +1,17 @@
-import json
 import argparse
+import threading
+from queue import Queue
 
+import orjson
+import soundfile as sf
+import soxr
 import torch
-from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor
 from tqdm import tqdm
 
+# Whisper expects 16 kHz input padded to 30 s windows
+WHISPER_SAMPLING_RATE = 16000
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Transcribe audio using a pre-trained model.")
     parser.add_argument("--input_jsonl", type=str, required=True, help="Path to the input JSONL file containing audio paths.")
@@ -12,8 +19,38 @@ def parse_args():
     parser.add_argument("--model_id", type=str, default="openai/whisper-large-v3", help="Pre-trained model ID.")
     parser.add_argument("--batch_size", type=int, default=8, help="Batch size for processing.")
     parser.add_argument("--data_dir", type=str, default="data/new", help="Directory containing audio files.")
+    parser.add_argument("--prefetch", type=int, default=4, help="Number of batches to prepare ahead of the GPU.")
     return parser.parse_args()
 
+
+def load_audio(path):
+    """Decode an audio file to mono float32 at Whisper's sampling rate."""
+    audio, sr = sf.read(path, dtype="float32", always_2d=True)
+    audio = audio.mean(axis=1)
+    if sr != WHISPER_SAMPLING_RATE:
+        audio = soxr.resample(audio, sr, WHISPER_SAMPLING_RATE)
+    return audio
+
+
+def load_batches(dataset, args, feature_extractor, device, queue):
+    """Decode and featurize batches in the background; puts None when done, or the exception on failure."""
+    try:
+        for i in range(0, len(dataset), args.batch_size):
+            batch = dataset[i:i + args.batch_size]
+            waveforms = [load_audio(f"{args.data_dir}/{item['audioPath'].split('/')[-1]}") for item in batch]
+            features = feature_extractor(
+                waveforms,
+                sampling_rate=WHISPER_SAMPLING_RATE,
+                return_tensors="pt",
+                device=device,
+            ).input_features
+            queue.put((batch, features))
+    except Exception as e:
+        queue.put(e)
+        return
+    queue.put(None)
+
+
 if __name__ == "__main__":
     args = parse_args()
 
@@ -27,29 +64,39 @@ if __name__ == "__main__":
     )
     model.to(device)
 
+    # Decode greedily into a fixed-size KV cache and compile the encoder, which sees the same 30 s input shape every batch
+    model.generation_config.cache_implementation = "static"
+    if device != "cpu":
+        model.model.encoder = torch.compile(model.model.encoder, mode="reduce-overhead")
+    generate_kwargs = {"language": "zh", "task": "transcribe", "max_new_tokens": 128, "num_beams": 1, "do_sample": False}
+
     processor = AutoProcessor.from_pretrained(model_id)
 
-    pipe = pipeline(
-        "automatic-speech-recognition",
-        model=model,
-        tokenizer=processor.tokenizer,
-        feature_extractor=processor.feature_extractor,
-        torch_dtype=torch_dtype,
-        chunk_length_s=30,
-        device=device,
-    )
+    with open(args.input_jsonl, "rb") as f:
+        dataset = [orjson.loads(line) for line in f]
 
-    with open(args.input_jsonl, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    dataset = [json.loads(line.strip()) for line in lines]
+    # Decode audio and compute log-mel features on a loader thread while the GPU generates
+    queue = Queue(maxsize=args.prefetch)
+    loader = threading.Thread(
+        target=load_batches, args=(dataset, args, processor.feature_extractor, device, queue), daemon=True
+    )
+    loader.start()
 
-    for i in tqdm(range(0, len(dataset), args.batch_size)):
-        batch = dataset[i:i + args.batch_size]
-        audio_paths = [f"{args.data_dir}/{item['audioPath'].split('/')[-1]}" for item in batch]
-        results = pipe(audio_paths, batch_size=args.batch_size, generate_kwargs={"language": "zh", "max_new_tokens": 128})
-        for item, result in zip(batch, results):
-            item["transcription"] = result["text"]
+    with tqdm(total=len(dataset)) as progress:
+        while (loaded := queue.get()) is not None:
+            if isinstance(loaded, Exception):
+                raise loaded
+            batch, features = loaded
+            # Pad the last batch so every generate call sees the same shape
+            if len(batch) < args.batch_size:
+                features = torch.nn.functional.pad(features, (0, 0, 0, 0, 0, args.batch_size - len(batch)))
+            with torch.inference_mode():
+                token_ids = model.generate(features.to(device, dtype=torch_dtype), **generate_kwargs)
+            texts = processor.batch_decode(token_ids[:len(batch)], skip_special_tokens=True)
+            for item, text in zip(batch, texts):
+                item["transcription"] = text
+            progress.update(len(batch))
+    loader.join()
 
-    with open(args.output_jsonl, "w", encoding="utf-8") as f:
-        for item in dataset:
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    with open(args.output_jsonl, "wb", buffering=1 << 20) as f:
+        f.writelines(orjson.dumps(item, option=orjson.OPT_APPEND_NEWLINE) for item in dataset)
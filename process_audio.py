@@ -2,11 +2,12 @@ import csv
 import argparse
 import os
 import sys
-import uuid
+import secrets
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 from tqdm import tqdm
 
-from utils import download_from_google_drive, download_from_yt, crop_audio
+from utils import download_from_google_drive, download_from_yt, crop_audio_batch, mark_uncropped
 
 MAX_AUDIO_LENGTH = 15  # seconds
 SUBSETS = [
@@ -23,21 +24,21 @@ SUBSETS = [
 ]
 
 
-def timestamp_to_ms(timestamp):
-    """Convert a timestamp in the format 'HH:MM:SS' to milliseconds."""
-    if timestamp is None or pd.isna(timestamp) or timestamp.strip() == "":
-        return -1
-    parts = list(map(int, timestamp.split(":")))
-    if len(parts) == 2:  # MM:SS format
-        minutes, seconds = parts
-        hours = 0
-    elif len(parts) == 3:  # HH:MM:SS format
-        hours, minutes, seconds = parts
-    else:
-        print(f"Invalid timestamp format: {timestamp}", file=sys.stderr)
-        return -1
+def timestamps_to_ms(timestamps: pd.Series) -> pd.Series:
+    """Convert a column of 'HH:MM:SS' or 'MM:SS' timestamps to milliseconds, -1 where missing or invalid."""
+    fields = timestamps.astype("string").str.strip().str.split(":", expand=True)
+    num_fields = fields.notna().sum(axis=1)
+    parts = fields.apply(pd.to_numeric, errors="coerce").reindex(columns=range(3))
+    valid = parts.notna().sum(axis=1).eq(num_fields) & num_fields.isin([2, 3])
+
+    # Right-align MM:SS rows so every row reads as hours, minutes, seconds
+    has_hours = num_fields.eq(3)
+    hours = parts[0].where(has_hours, 0)
+    minutes = parts[1].where(has_hours, parts[0])
+    seconds = parts[2].where(has_hours, parts[1])
 
-    return (hours * 3600 + minutes * 60 + seconds) * 1000
+    ms = (hours * 3600 + minutes * 60 + seconds) * 1000
+    return ms.where(valid, -1).astype("int64")
 
 
 def get_args():
@@ -70,6 +71,23 @@ def get_args():
         default="data/audio",
         help="Directory where audio files are stored (default: data/audio).",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=16,
+        help="Number of concurrent downloads (default: 16).",
+    )
+    parser.add_argument(
+        "--crop_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of ffmpeg crops run at once (default: CPU count).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Download audio again even if it already exists.",
+    )
     return parser.parse_args()
 
 
@@ -81,6 +99,7 @@ def process_audio_download(row, args):
             format=args.format,
             output_path=args.audio_dir,
             output_id=row["unique_id"],
+            force=args.force,
         )
     elif "youtu" in row["link"]:
         return download_from_yt(
@@ -88,10 +107,28 @@ def process_audio_download(row, args):
             format=args.format,
             output_path=args.audio_dir,
             output_id=row["unique_id"],
+            force=args.force,
         )
     else:
         print(f"Unsupported link format: {row['link']}", file=sys.stderr)
-        return None
+        return "", False
+
+
+def downloaded_crop_specs(records, args, executor, positions):
+    """Download every record on executor and yield crop specs as downloads finish.
+
+    Appends each yielded record's position to positions, so crop results can be matched back to rows.
+    """
+    futures = {executor.submit(process_audio_download, row, args): i for i, row in enumerate(records)}
+    for future in tqdm(as_completed(futures), total=len(futures), desc="Processing audio files"):
+        i = futures[future]
+        audio_path, need_crop = future.result()
+        if not audio_path:
+            continue
+        if need_crop:
+            mark_uncropped(audio_path)
+        positions.append(i)
+        yield audio_path, int(records[i]["start_ms"]), int(records[i]["end_ms"]), need_crop
 
 
 def main(args):
@@ -102,35 +139,42 @@ def main(args):
     df = pd.read_csv(args.input_file, encoding="utf-8")
 
     # Generate unique IDs for each entry
-    df["unique_id"] = [str(uuid.uuid4().hex)[:8].upper() for _ in range(len(df))]
+    df["unique_id"] = [secrets.token_hex(4).upper() for _ in range(len(df))]
 
     # Initialize audio_path column
     df["audio_path"] = None
 
-    # Process each row with progress bar
-    tqdm.pandas(desc="Processing audio files")
-    df["audio_path"] = df.progress_apply(
-        lambda row: process_audio_download(row, args), axis=1
-    )
-
     if "start" in df.columns:
-        df["start_ms"] = df["start"].apply(timestamp_to_ms)
+        df["start_ms"] = timestamps_to_ms(df["start"])
 
     if "end" in df.columns:
-        df["end_ms"] = df["end"].apply(timestamp_to_ms)
-
-    # Crop audio files if necessary
-    tqdm.pandas(desc="Cropping audio files")
-    df[["audio_path", "start_ms", "end_ms"]] = df.progress_apply(
-        lambda row: crop_audio(
-            row["audio_path"],
-            start_ms=row.get("start_ms", 0),
-            end_ms=row.get("end_ms", MAX_AUDIO_LENGTH * 1000),
+        df["end_ms"] = timestamps_to_ms(df["end"])
+
+    if "start_ms" not in df.columns:
+        df["start_ms"] = 0
+    if "end_ms" not in df.columns:
+        df["end_ms"] = MAX_AUDIO_LENGTH * 1000
+
+    # Downloads wait on the network and crops on an ffmpeg subprocess, so both run on threads;
+    # each file is cropped as soon as its download finishes
+    records = df.to_dict("records")
+    positions = []
+    executor = ThreadPoolExecutor(max_workers=args.num_workers)
+    try:
+        cropped = crop_audio_batch(
+            downloaded_crop_specs(records, args, executor, positions),
             output_format=args.format,
             max_length=MAX_AUDIO_LENGTH * 1000,
-        ),
-        axis=1,
-    ).apply(pd.Series)
+            workers=args.crop_workers,
+        )
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    # Rows whose download or crop failed keep an empty audio_path
+    df["audio_path"] = ""
+    for i, result in zip(positions, cropped):
+        if result is not None:
+            df.loc[df.index[i], ["audio_path", "start_ms", "end_ms"]] = result
     # Drop start, end, link columns
     df.drop(columns=["start", "end"], inplace=True, errors="ignore")
 
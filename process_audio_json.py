@@ -4,6 +4,7 @@ import json
 import os
 import sys
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from tqdm import tqdm
 
@@ -12,6 +13,7 @@ from utils import (
     download_from_google_drive,
     download_from_yt,
     crop_audio,
+    mark_uncropped,
 )
 
 MAX_AUDIO_LENGTH = 30  # seconds
@@ -76,6 +78,17 @@ def get_args():
         default="data/audio",
         help="Directory where audio files are stored (default: data/audio).",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=16,
+        help="Number of files downloaded and cropped concurrently (default: 16).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Download audio again even if it already exists.",
+    )
     return parser.parse_args()
 
 
@@ -89,6 +102,7 @@ def process_audio_download(row, args, audio_idx=1) -> tuple[str, bool]:
                 output_path=args.audio_dir,
                 output_id=row["unique_id"],
                 audio_idx=audio_idx,
+                force=args.force,
             )
         elif "youtu" in row[f"link_{audio_idx}"]:
             return download_from_yt(
@@ -99,6 +113,7 @@ def process_audio_download(row, args, audio_idx=1) -> tuple[str, bool]:
                 output_path=args.audio_dir,
                 output_id=row["unique_id"],
                 audio_idx=audio_idx,
+                force=args.force,
             )
         else:
             return download_from_curl(
@@ -107,6 +122,7 @@ def process_audio_download(row, args, audio_idx=1) -> tuple[str, bool]:
                 output_path=args.audio_dir,
                 output_id=row["unique_id"],
                 audio_idx=audio_idx,
+                force=args.force,
             )
     except Exception as e:
         print(
@@ -116,6 +132,36 @@ def process_audio_download(row, args, audio_idx=1) -> tuple[str, bool]:
         return "", False
 
 
+def process_audio_link(row, args, audio_idx):
+    """Download one link of a row and crop it as soon as it arrives; None if either step fails."""
+    audio_path, need_crop = process_audio_download(row, args, audio_idx)
+    if not audio_path:
+        return None
+    if need_crop:
+        mark_uncropped(audio_path)
+    try:
+        audio_path, start_ms, end_ms = crop_audio(
+            audio_path,
+            timestamp_to_ms(row.get(f"start_{audio_idx}")),
+            timestamp_to_ms(row.get(f"end_{audio_idx}")),
+            args.format,
+            max_length=MAX_AUDIO_LENGTH * 1000,
+            need_crop=need_crop,
+        )
+    except Exception as e:
+        print(
+            f"Error cropping audio for {row['unique_id']} (link {audio_idx}): {e}",
+            file=sys.stderr,
+        )
+        return None
+    return {
+        "link": row[f"link_{audio_idx}"],
+        "audio_path": audio_path,
+        "start_ms": start_ms,
+        "end_ms": end_ms,
+    }
+
+
 def main(args):
 
     os.makedirs(args.audio_dir, exist_ok=True)
@@ -124,52 +170,47 @@ def main(args):
         reader = csv.DictReader(f)
         data = list(reader)
 
-    for idx, row in enumerate(tqdm(data, desc="Processing Rows")):
-        row["unique_id"] = f"{idx:0>8d}"  # Generate unique ID
-        audio_data = []
-        for audio_idx in range(1, 4):
-            if not row.get(f"link_{audio_idx}"):
-                continue
-            audio_path, need_crop = process_audio_download(row, args, audio_idx)
-            start_ms = timestamp_to_ms(row.get(f"start_{audio_idx}"))
-            end_ms = timestamp_to_ms(row.get(f"end_{audio_idx}"))
-
-            if audio_path:
-                audio_path, start_ms, end_ms = crop_audio(
-                    audio_path,
-                    start_ms,
-                    end_ms,
-                    args.format,
-                    max_length=MAX_AUDIO_LENGTH * 1000,
-                    need_crop=need_crop,
-                )
-                audio_data.append(
-                    {
-                        "link": row[f"link_{audio_idx}"],
-                        "audio_path": audio_path,
-                        "start_ms": start_ms,
-                        "end_ms": end_ms,
-                    }
-                )
-        row["audio"] = audio_data
-        for key in [
-            "link_1",
-            "link_2",
-            "link_3",
-            "start_1",
-            "start_2",
-            "start_3",
-            "end_1",
-            "end_2",
-            "end_3",
-            "check_1",
-            "check_2",
-            "check_3"
-        ]:
-            row.pop(key, None)
+    # Download and crop every link concurrently; both steps wait on the network or an
+    # ffmpeg subprocess, so threads are enough
+    executor = ThreadPoolExecutor(max_workers=args.num_workers)
+    try:
+        pending = []
+        for idx, row in enumerate(data):
+            row["unique_id"] = f"{idx:0>8d}"  # Generate unique ID
+            pending.append(
+                [
+                    executor.submit(process_audio_link, row, args, audio_idx)
+                    for audio_idx in range(1, 4)
+                    if row.get(f"link_{audio_idx}")
+                ]
+            )
+
+        # Write each row, in input order, as soon as all of its links are done
         with open(args.output_file, "a", encoding="utf-8") as out_f:
-            json.dump(row, out_f, ensure_ascii=False)
-            out_f.write("\n")
+            for row, futures in zip(tqdm(data, desc="Processing Rows"), pending):
+                row["audio"] = [
+                    audio for future in futures if (audio := future.result()) is not None
+                ]
+                for key in [
+                    "link_1",
+                    "link_2",
+                    "link_3",
+                    "start_1",
+                    "start_2",
+                    "start_3",
+                    "end_1",
+                    "end_2",
+                    "end_3",
+                    "check_1",
+                    "check_2",
+                    "check_3"
+                ]:
+                    row.pop(key, None)
+                json.dump(row, out_f, ensure_ascii=False)
+                out_f.write("\n")
+                out_f.flush()
+    finally:
+        executor.shutdown(cancel_futures=True)
 
 
 if __name__ == "__main__":
@@ -48,19 +48,22 @@ def main(args):
         }
     )
 
-    for type_name in df["type"].unique():
-        type_df = df[df["type"] == type_name].copy()
+    # Rename audio_path to audio and remove description column
+    df = df.rename(columns={"audio_path": "audio"}).drop("description", axis=1)
 
-        # Rename audio_path to audio and remove type column
-        type_df = type_df.rename(columns={"audio_path": "audio"})
+    # groupby splits the frame in a single pass instead of one mask per type
+    for type_name, type_df in df.groupby("type", sort=False):
         type_df = type_df.drop("type", axis=1)
-        type_df = type_df.drop("description", axis=1)
 
         # Create dataset with explicit features
         dataset = Dataset.from_pandas(type_df, features=features, preserve_index=False)
 
-        dataset.push_to_hub(args.repo_id, config_name=type_name, private=args.private)
-
+        dataset.push_to_hub(
+            args.repo_id,
+            config_name=type_name,
+            private=args.private,
+            num_shards=max(1, len(type_df) // 1000),
+        )
 
 if __name__ == "__main__":
     args = parse_args()
@@ -1,4 +1,3 @@
-import json
 import os
 import argparse
 from utils import (
@@ -6,6 +5,7 @@ from utils import (
     download_from_yt,
     download_from_curl
 )
+from jsonl_io import read_jsonl
 from tqdm import tqdm
 
 def parse_args():
@@ -17,6 +17,11 @@ def parse_args():
         required=True,
         help="Path to the input JSONL file containing audio file paths.",
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Download audio again even if it already exists.",
+    )
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -25,8 +30,7 @@ if __name__ == "__main__":
         print(f"Input file {args.input_file} does not exist.")
         exit(1)
 
-    with open(args.input_file, 'r') as f:
-        data = [json.loads(line) for line in f]
+    data = list(read_jsonl(args.input_file))
 
     output_data = []
     output_path = "raw"
@@ -39,15 +43,15 @@ if __name__ == "__main__":
         
         if "drive" in row['link']:
             audio_path, success = download_from_google_drive(
-                row['link'], output_path=output_path, output_id=output_id, audio_idx=audio_idx
+                row['link'], output_path=output_path, output_id=output_id, audio_idx=audio_idx, force=args.force
             )
         elif "youtu" in row['link']:
             audio_path, success = download_from_yt(
-                row['link'].split("&")[0], output_path=output_path, output_id=output_id, audio_idx=audio_idx
+                row['link'].split("&")[0], output_path=output_path, output_id=output_id, audio_idx=audio_idx, force=args.force
             )
         else:
             audio_path, success = download_from_curl(
-                row['link'], output_path=output_path, output_id=output_id, audio_idx=audio_idx
+                row['link'], output_path=output_path, output_id=output_id, audio_idx=audio_idx, force=args.force
             )
         
         if not audio_path:
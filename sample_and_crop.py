@@ -1,16 +1,25 @@
-import json
 import os
 import argparse
+import subprocess
 from utils import (
     download_from_google_drive,
     download_from_yt,
-    download_from_curl
+    download_from_curl,
+    get_duration_ms,
+    run_ffmpeg,
 )
+from jsonl_io import dumps_line, read_jsonl
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
-from pydub import AudioSegment
+import lameenc
+import numpy as np
+import soundfile as sf
+import soxr
 
 SAMPLING_RATE = 44100
 MAX_AUDIO_LENGTH = 30 * 1000  # in milliseconds
+MP3_BIT_RATE = 128  # kbps, matching ffmpeg's default for the old pydub export
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Process audio files and save to JSON.")
@@ -46,59 +55,114 @@ def parse_args():
         action="store_true",
         help="If set, only verify the validity of the JSONL file without processing audio.",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes decoding and encoding audio (default: CPU count).",
+    )
     return parser.parse_args()
 
-if __name__ == "__main__":
-    args = parse_args()
-    if not os.path.exists(args.input_file):
-        print(f"Input file {args.input_file} does not exist.")
-        exit(1)
-
-    with open(args.input_file, 'r') as f:
-        data = [json.loads(line) for line in f]
 
-    output_data = []
-    output_path = "raw"
-    success_count = 0
-    os.makedirs(args.output_dir, exist_ok=True)
-    
-    for idx, row in enumerate(tqdm(data)):
+def encode_mp3(audio: np.ndarray, sample_rate: int) -> bytes:
+    """Encode float samples shaped (frames, channels) as MP3."""
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(MP3_BIT_RATE)
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(pcm.shape[1])
+    encoder.set_quality(2)
+    return encoder.encode(pcm.tobytes()) + encoder.flush()
 
-        save_path = os.path.join(args.audio_dir, row['audioPath'].split("/")[-1])
 
-        # Resample to sr
+def crop_row(row, args):
+    """Clamp a row's crop window and write the cropped, resampled MP3; returns the updated row or None."""
+    save_path = os.path.join(args.audio_dir, row['audioPath'].split("/")[-1])
+    output_path = os.path.join(args.output_dir, row['audioPath'].split("/")[-1])
+    try:
+        # Read the length from the header; only the kept window is decoded later.
+        # lameenc takes at most two channels, so ffmpeg downmixes anything wider.
         if not args.verify_only:
-            audio = AudioSegment.from_file(save_path)
-            audio = audio.set_frame_rate(SAMPLING_RATE)
-        
+            try:
+                info = sf.info(save_path)
+                use_ffmpeg = info.channels > 2
+                sr = info.samplerate
+                audio_ms = info.frames * 1000 // sr
+            except sf.LibsndfileError:
+                # Formats libsndfile cannot read (e.g. m4a, webm) go through ffmpeg
+                use_ffmpeg = True
+                audio_ms = get_duration_ms(save_path)
+
         # Crop according to start_ms and end_ms
         start_ms = row.get('startMs', -1)
         end_ms = row.get('endMs', -1)
         if start_ms < 0:
             start_ms = 0
             print(f"Warning: start_ms < 0 for {save_path}, setting to 0")
-        
-        if not args.verify_only and end_ms > len(audio):
+
+        if not args.verify_only and end_ms > audio_ms:
             print(f"Warning: end_ms > audio length for {save_path}, setting to audio length")
-            end_ms = len(audio)
+            end_ms = audio_ms
 
         if end_ms < 0 or end_ms - start_ms > MAX_AUDIO_LENGTH:
             if args.verify_only:
                 print(f"Warning: end_ms < 0 or too long for {save_path}, skipping verification")
-                continue
-            end_ms = min(start_ms + MAX_AUDIO_LENGTH, len(audio))
+                return None
+            end_ms = min(start_ms + MAX_AUDIO_LENGTH, audio_ms)
             print(f"Warning: end_ms < 0 or too long for {save_path}, setting to {end_ms}")
-        
-        
 
-        if not args.verify_only:
-            new_row = row.copy()
-            new_row['startMs'] = start_ms
-            new_row['endMs'] = end_ms
-            output_data.append(new_row)
-            audio = audio[start_ms:end_ms]
-            output_path = os.path.join(args.output_dir, row['audioPath'].split("/")[-1])
-            audio.export(output_path, format="mp3")
-            
-            with open(args.output_file, '+a') as f:
-                f.write(json.dumps(new_row, ensure_ascii=False) + "\n")
\ No newline at end of file
+        if args.verify_only:
+            return None
+
+        new_row = row.copy()
+        new_row['startMs'] = start_ms
+        new_row['endMs'] = end_ms
+        if use_ffmpeg:
+            try:
+                run_ffmpeg(
+                    "-ss", f"{start_ms / 1000:.3f}", "-t", f"{(end_ms - start_ms) / 1000:.3f}", "-i", save_path, "-vn",
+                    "-ar", str(SAMPLING_RATE), "-b:a", f"{MP3_BIT_RATE}k", "-f", "mp3", output_path,
+                )
+            except subprocess.CalledProcessError:
+                # Do not leave a truncated MP3 behind
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                raise
+            return new_row
+        audio, _ = sf.read(
+            save_path,
+            start=start_ms * sr // 1000,
+            stop=end_ms * sr // 1000,
+            dtype="float32",
+            always_2d=True,
+        )
+        if sr != SAMPLING_RATE:
+            audio = soxr.resample(audio, sr, SAMPLING_RATE)
+        mp3 = encode_mp3(audio, SAMPLING_RATE)
+        with open(output_path, "wb") as f:
+            f.write(mp3)
+        return new_row
+    except Exception as e:
+        # One unreadable file should not abort the whole pool; its row is left out of the output
+        print(f"Failed to crop {save_path}: {e}")
+        return None
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.exists(args.input_file):
+        print(f"Input file {args.input_file} does not exist.")
+        exit(1)
+
+    data = list(read_jsonl(args.input_file))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Decoding, resampling and MP3 encoding are CPU-bound, so spread rows over processes
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor, \
+            open(args.output_file, 'ab', buffering=1 << 20) as f:
+        for new_row in tqdm(
+            executor.map(partial(crop_row, args=args), data, chunksize=8),
+            total=len(data),
+        ):
+            if new_row is not None:
+                f.write(dumps_line(new_row))
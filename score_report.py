@@ -1,5 +1,18 @@
-import json
 import argparse
+import mmap
+import os
+import re
+from collections import Counter
+from operator import itemgetter
+
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
+
+# Matches a plain (escape-free) uniqueId string so subset lines need not be fully parsed
+_UID_RE = re.compile(rb'"uniqueId"\s*:\s*"([^"\\]*)"')
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Give report to accuracy and F1 score.")
@@ -8,32 +21,80 @@ def parse_args():
     parser.add_argument("-o", "--output_file", type=str, default="", help="Path to the output JSONL file if subset is specified.")
     return parser.parse_args()
 
+
+def read_unique_id(line: bytes) -> str:
+    """Pull uniqueId out of a JSONL line, falling back to a full parse for escaped or nested values."""
+    match = _UID_RE.search(line) if line.count(b'"uniqueId"') == 1 else None
+    return match.group(1).decode() if match else orjson.loads(line)["uniqueId"]
+
+
+def iter_lines(path):
+    """Yield each line of a file as bytes, without its newline, by scanning a memory map."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while (end := mm.find(b"\n", start)) != -1:
+                yield mm[start:end]
+                start = end + 1
+            if start < len(mm):
+                yield mm[start:]
+
+
+def count_with_arrow(input_file, subset_ids=None) -> Counter:
+    """Count (hopType, correct) pairs with Arrow's columnar JSON reader and compute kernels."""
+    schema = pa.schema([("uniqueId", pa.string()), ("hopType", pa.string()), ("correct", pa.bool_())])
+    table = pa_json.read_json(
+        input_file,
+        parse_options=pa_json.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore"),
+    )
+    if subset_ids is not None:
+        table = table.filter(pc.is_in(table["uniqueId"], value_set=pa.array(list(subset_ids), pa.string())))
+    grouped = table.group_by(["hopType", "correct"]).aggregate([([], "count_all")]).to_pydict()
+    return Counter({
+        (hop_type, bool(correct)): n
+        for hop_type, correct, n in zip(grouped["hopType"], grouped["correct"], grouped["count_all"])
+    })
+
+
 if __name__ == "__main__":
     args = parse_args()
 
-    with open(args.input_file, "r", encoding='utf-8') as f:
-        data = [json.loads(line) for line in f]
-
+    subset_ids = None
     if args.subset:
-        with open(args.subset, "r", encoding='utf-8') as f:
-            subset_ids = {json.loads(line)["uniqueId"] for line in f}
-            data = [entry for entry in data if entry["uniqueId"] in subset_ids]
+        with open(args.subset, "rb") as f:
+            subset_ids = frozenset(map(read_unique_id, filter(bytes.strip, f)))
 
-    print(f"Loaded {len(data)} entries from {args.input_file}")
+    if not args.output_file:
+        counts = count_with_arrow(args.input_file, subset_ids)
+    else:
+        # Count in a single streaming pass; kept lines are copied to the output unchanged
+        counts = Counter()  # (hopType, correct) -> entries
+        get_result = itemgetter("hopType", "correct")
+        with open(args.output_file, "wb") as output_file:
+            for line in iter_lines(args.input_file):
+                if not line.strip():
+                    continue
+                # Check the subset on the raw bytes so skipped lines are never fully parsed
+                if subset_ids is not None and read_unique_id(line) not in subset_ids:
+                    continue
+                entry = orjson.loads(line)
+                hop_type, correct = get_result(entry)
+                counts[(hop_type, bool(correct))] += 1
+                output_file.write(line + b"\n")
 
-    single_hop_count = sum(1 for entry in data if entry["hopType"] == "Single-hop")
-    multi_hop_count = sum(1 for entry in data if entry["hopType"] == "Multi-hop")
+    total = sum(counts.values())
+    correct_count = sum(n for (_, correct), n in counts.items() if correct)
+    single_hop_correct = counts[("Single-hop", True)]
+    single_hop_count = single_hop_correct + counts[("Single-hop", False)]
+    multi_hop_correct = counts[("Multi-hop", True)]
+    multi_hop_count = multi_hop_correct + counts[("Multi-hop", False)]
+
+    print(f"Loaded {total} entries from {args.input_file}")
     print(f"Single-hop questions: {single_hop_count}, Multi-hop questions: {multi_hop_count}")
-    
-    correct_count = sum(1 for entry in data if entry["correct"])
-    single_hop_correct = sum(1 for entry in data if entry["correct"] and entry["hopType"] == "Single-hop")
-    multi_hop_correct = sum(1 for entry in data if entry["correct"] and entry["hopType"] == "Multi-hop")
-    accuracy = correct_count / len(data)
+
+    accuracy = correct_count / total
     single_hop_accuracy = single_hop_correct / single_hop_count if single_hop_count > 0 else 0
     multi_hop_accuracy = multi_hop_correct / multi_hop_count if multi_hop_count > 0 else 0
     print(f"Accuracy: {accuracy:.4f}, Single-hop Accuracy: {single_hop_accuracy:.4f}, Multi-hop Accuracy: {multi_hop_accuracy:.4f}")
-
-    if args.output_file:
-        with open(args.output_file, "w", encoding='utf-8') as f:
-            for entry in data:
-                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
@@ -1,24 +1,237 @@
+import json
 import random
 import time
-import pydub
-import gdown
-import yt_dlp
+import requests
+import secrets
+import soundfile as sf
+import soxr
 import os
 import shutil
-import uuid
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 
 SAMPLING_RATE = 44100  # Hz
+MIN_AUDIO_BYTES = 1024  # smaller files are treated as failed or partial downloads
+_FFMPEG_PATH = shutil.which("ffmpeg")  # looked up once; checked when a download needs it
+DRIVE_DOWNLOAD_URL = "https://drive.usercontent.google.com/download"
+PROBE_BYTES = 1 << 20  # leading bytes of a stream handed to ffprobe
 
 
+class DownloadError(Exception):
+    """A download failed in a way that may succeed if tried again."""
+
+
+# Network and subprocess failures worth retrying; anything else (e.g. a missing ffmpeg) propagates
+TRANSIENT_ERRORS = (
+    DownloadError,
+    requests.RequestException,
+    subprocess.CalledProcessError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def retry(tries=5, base=3, exceptions=TRANSIENT_ERRORS):
+    """Retry a download that raises a transient error, backing off exponentially; gives ("", False) once out of tries."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(tries):
+                if attempt > 0:
+                    print(f"Retrying {func.__name__} (attempt {attempt + 1})")
+                try:
+                    return func(*args, **kwargs)
+                except exceptions as e:
+                    if attempt == tries - 1:
+                        print(f"Failed to download after {tries} attempts: {e}")
+                        return "", False
+                    time.sleep(base ** (attempt + 1) + random.uniform(0, 1))  # Wait before retrying
+
+        return wrapper
+
+    return decorator
+
+
+def is_downloaded(path: str) -> bool:
+    """Whether a previous run already left a usable file at path."""
+    return os.path.exists(path) and os.path.getsize(path) > MIN_AUDIO_BYTES
+
+
+def uncropped_marker(audio_path: str) -> str:
+    """Path of the empty file recording that audio_path was downloaded but not cropped yet."""
+    return f"{audio_path}.uncropped"
+
+
+def mark_uncropped(audio_path: str):
+    """Record that a fresh download still needs cropping; crop_audio clears the mark once it succeeds.
+
+    The marker outlives an interrupted run, so a rerun still crops files it downloaded but never cropped.
+    """
+    open(uncropped_marker(audio_path), "wb").close()
+
+
+def existing_download(output_file: str, force: bool) -> tuple[str, bool] | None:
+    """Result for a download a previous run already finished, or None if it must run."""
+    if not force and is_downloaded(output_file):
+        print(f"File {output_file} already exists, skipping download.")
+        return output_file, os.path.exists(uncropped_marker(output_file))
+    return None
+
+
+def run_ffmpeg(*args):
+    """Run ffmpeg quietly, raising if it fails."""
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", *args],
+        check=True,
+        stdin=subprocess.DEVNULL,  # keep concurrent ffmpeg processes off the terminal's input
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def get_duration_ms(audio_path: str) -> int:
+    """Duration of an audio file in milliseconds, read by ffprobe without decoding."""
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=duration",
+            "-of",
+            "default=noprint_wrappers=1:nokey=1",
+            audio_path,
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return int(float(result.stdout) * 1000)
+
+
+def probe_audio(source) -> tuple[list[str], int]:
+    """Container names and first audio stream sample rate of a file path or leading bytes, read by ffprobe."""
+    from_bytes = isinstance(source, bytes)
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "format=format_name:stream=sample_rate",
+            "-of",
+            "json",
+            "pipe:0" if from_bytes else source,
+        ],
+        input=source if from_bytes else None,
+        check=True,
+        capture_output=True,
+    )
+    info = json.loads(result.stdout)
+    streams = info.get("streams") or [{}]
+    return info.get("format", {}).get("format_name", "").split(","), int(streams[0].get("sample_rate", 0))
+
+
+def is_target_audio(source, format: str) -> bool:
+    """Whether source is already in the target container at SAMPLING_RATE, so it can be kept as is."""
+    try:
+        format_names, sample_rate = probe_audio(source)
+    except subprocess.CalledProcessError:
+        return False
+    return format in format_names and sample_rate == SAMPLING_RATE
+
+
+def resample_wav(input_file: str, output_file: str) -> bool:
+    """Resample a WAV/FLAC file to a SAMPLING_RATE WAV in-process; False if soundfile cannot read it."""
+    try:
+        audio, sr = sf.read(input_file, dtype="float32", always_2d=True)
+    except sf.LibsndfileError:
+        return False
+    if sr != SAMPLING_RATE:
+        audio = soxr.resample(audio, sr, SAMPLING_RATE)
+    sf.write(output_file, audio, SAMPLING_RATE, format="WAV")
+    return True
+
+
+def stream_drive_to_ffmpeg(file_id: str, output_file: str, format: str) -> bool:
+    """Pipe a public Drive file straight into ffmpeg, or straight to disk if it already matches.
+
+    Writes to a temporary path and moves it into place only once complete, so an
+    interrupted download never leaves a partial file behind.
+    Returns False if Drive or ffmpeg cannot handle it as a stream.
+    """
+    tmp_file = f"{output_file}.part"
+    process = None
+    try:
+        with requests.get(
+            DRIVE_DOWNLOAD_URL,
+            params={"id": file_id, "export": "download", "confirm": "t"},
+            stream=True,
+            timeout=60,
+        ) as response:
+            if 400 <= response.status_code < 500:
+                # Private, missing or quota-limited files will not recover on retry; let gdown try
+                return False
+            response.raise_for_status()  # 5xx errors are retried
+            if response.headers.get("Content-Type", "").startswith("text/html"):
+                # Drive answered with a confirmation or error page instead of the file
+                return False
+            response.raw.decode_content = True
+
+            # Skip the re-encode when the file is already what we would produce
+            head = response.raw.read(PROBE_BYTES)
+            if is_target_audio(head, format):
+                with open(tmp_file, "wb") as f:
+                    f.write(head)
+                    shutil.copyfileobj(response.raw, f, 1 << 20)
+                os.replace(tmp_file, output_file)
+                return True
+
+            process = subprocess.Popen(
+                [
+                    "ffmpeg", "-y", "-loglevel", "error",
+                    "-i", "pipe:0",
+                    "-vn", "-ar", str(SAMPLING_RATE),
+                    "-f", format,
+                    tmp_file,
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+            )
+            try:
+                process.stdin.write(head)
+                shutil.copyfileobj(response.raw, process.stdin, 1 << 20)
+            except BrokenPipeError:
+                pass  # ffmpeg gave up early; its exit status says why
+            finally:
+                process.stdin.close()
+        if process.wait() != 0:
+            # Containers that need seeking (e.g. MP4 with a trailing index) cannot be read from a pipe
+            return False
+        os.replace(tmp_file, output_file)
+        return True
+    except BaseException:
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        raise
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+@retry(tries=5, base=3)
 def download_from_google_drive(
-    url, format="mp3", output_path="data/audio", output_id=None, audio_idx=None
+    url, format="mp3", output_path="data/audio", output_id=None, audio_idx=None, force=False
 ) -> tuple[str, bool]:
     os.makedirs(output_path, exist_ok=True)
 
     if not output_id:
-        output_id = str(uuid.uuid4().hex)[
-            :8
-        ].upper()  # Generate a unique ID if not provided
+        output_id = secrets.token_hex(4).upper()  # Generate a unique ID if not provided
     # Extract the file ID from the URL
     file_id = url.split("/")[-2]
     if audio_idx:
@@ -26,62 +239,64 @@ def download_from_google_drive(
     else:
         output_file = os.path.join(output_path, f"{output_id}.{format}")
 
-    os.makedirs("tmp", exist_ok=True)
+    if (existing := existing_download(output_file, force)) is not None:
+        return existing
 
-    if os.path.exists(output_file):
-        print(f"File {output_file} already exists, skipping download.")
-        return output_file, False
+    # Decode, resample and encode while downloading, without a local copy
+    if stream_drive_to_ffmpeg(file_id, output_file, format):
+        return output_file, True
 
-    for attempt in range(5):
-        if attempt > 0:
-            print(f"Retrying download from Google Drive (attempt {attempt + 1})")
-        
-        
+    # Fall back to gdown and a seekable local copy
+    import gdown  # imported on first use; it is slow to load and only this path needs it
+
+    # A private directory per call, so concurrent downloads of files sharing a Drive name cannot collide;
+    # it sits next to output_file so the finished file is moved into place atomically
+    tmp_dir = tempfile.mkdtemp(prefix=".gdown-", dir=output_path)
+    try:
+        download_dir = os.path.join(tmp_dir, "download")
+        os.makedirs(download_dir)
         try:
             downloaded_file = gdown.download(
-                f"https://drive.google.com/uc?id={file_id}", f"tmp/", quiet=True
+                f"https://drive.google.com/uc?id={file_id}", f"{download_dir}/", quiet=True
             )
-            if not downloaded_file:
-                raise Exception("Download failed, file not found.")
-            break  # Exit loop if download is successful
-            
         except Exception as e:
-            if attempt == 4:
-                print(f"Failed to download after 5 attempts: {e}")
-                return "", False
-            time.sleep(3 ** (attempt + 1) + random.uniform(0, 1))  # Wait before retrying
+            raise DownloadError(f"gdown failed: {e}") from e
+        if not downloaded_file:
+            raise DownloadError("Download failed, file not found.")
 
-    audio = pydub.AudioSegment.from_file(downloaded_file)
-    audio = audio.set_frame_rate(SAMPLING_RATE)
-    audio.export(output_file, format=format)
-    os.remove(downloaded_file)
+        converted_file = os.path.join(tmp_dir, f"converted.{format}")
+        if is_target_audio(downloaded_file, format):
+            converted_file = downloaded_file
+        elif not (format == "wav" and resample_wav(downloaded_file, converted_file)):
+            run_ffmpeg("-i", downloaded_file, "-vn", "-ar", str(SAMPLING_RATE), "-f", format, converted_file)
+        os.replace(converted_file, output_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
     return output_file, True
 
 
+@retry(tries=5, base=3)
 def download_from_yt(
-    url, format="mp3", output_path="data/audio", output_id=None, audio_idx=None
+    url, format="mp3", output_path="data/audio", output_id=None, audio_idx=None, force=False
 ) -> tuple[str, bool]:
     os.makedirs(output_path, exist_ok=True)
 
-    ffmpeg_path = shutil.which("ffmpeg")
-
-    if ffmpeg_path is None:
+    if _FFMPEG_PATH is None:
         raise RuntimeError(
             "ffmpeg not found. Please install ffmpeg or provide the path using ffmpeg_path parameter."
         )
 
     if not output_id:
-        output_id = str(uuid.uuid4().hex)[:8].upper()
+        output_id = secrets.token_hex(4).upper()
 
     if audio_idx:
         output_file = os.path.join(output_path, f"{output_id}_{audio_idx}")
     else:
         output_file = os.path.join(output_path, output_id)
 
-    if os.path.exists(f"{output_file}.{format}"):
-        print(f"File {output_file}.{format} already exists, skipping download.")
-        return f"{output_file}.{format}", False
+    if (existing := existing_download(f"{output_file}.{format}", force)) is not None:
+        return existing
 
     ydl_opts = {
         "format": "bestaudio/best",
@@ -99,64 +314,116 @@ def download_from_yt(
         "outtmpl": output_file,
         "noplaylist": True,
         "quiet": True,
-        "ffmpeg_location": ffmpeg_path,
+        "ffmpeg_location": _FFMPEG_PATH,
     }
 
+    import yt_dlp  # imported on first use; it is slow to load and only this downloader needs it
+
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             ydl.download([url])
-        return f"{output_file}.{format}", True
-    except Exception as e:
-        print(f"Download failed: {e}")
-        return "", False
+    except yt_dlp.utils.DownloadError as e:
+        raise DownloadError(str(e)) from e
+    return f"{output_file}.{format}", True
 
 
+@retry(tries=5, base=3)
 def download_from_curl(
-    url, format="mp3", output_path="data/audio", output_id=None, audio_idx=None
+    url, format="mp3", output_path="data/audio", output_id=None, audio_idx=None, force=False
 ) -> tuple[str, bool]:
     os.makedirs(output_path, exist_ok=True)
 
     if not output_id:
-        output_id = str(uuid.uuid4().hex)[:8].upper()
+        output_id = secrets.token_hex(4).upper()
 
     if audio_idx:
         output_file = os.path.join(output_path, f"{output_id}_{audio_idx}.{format}")
     else:
         output_file = os.path.join(output_path, f"{output_id}.{format}")
 
-    if os.path.exists(output_file):
-        print(f"File {output_file} already exists, skipping download.")
-        return output_file, False
+    if (existing := existing_download(output_file, force)) is not None:
+        return existing
+
+    # -f turns HTTP errors into a non-zero exit instead of saving the error page
+    subprocess.run(
+        ["curl", "-sLf", "--retry", "3", "--retry-delay", "2", "-o", output_file, url],
+        check=True,
+    )
+    return output_file, True
 
-    try:
-        os.system(f"curl -sL {url} -o {output_file}")
-        return output_file, True
-    except Exception as e:
-        print(f"Download failed: {e}")
-        return "", False
+
+def download_batch(urls, kind="yt", workers=8, **kwargs) -> list[tuple[str, bool]]:
+    """Download many URLs of one kind ("yt", "drive" or "curl") concurrently, in input order."""
+    download = {
+        "yt": download_from_yt,
+        "drive": download_from_google_drive,
+        "curl": download_from_curl,
+    }[kind]
+    # Each download waits on the network or an ffmpeg subprocess, so threads overlap well
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(partial(download, **kwargs), urls))
 
 
 def crop_audio(
     audio_path: str, start_ms: int, end_ms: int, output_format="mp3", max_length=15000, need_crop=True
 ):
     """Crop audio file from start_ms to end_ms."""
-    
-    audio = pydub.AudioSegment.from_file(audio_path)
     if start_ms < 0:
         start_ms = 0
     if end_ms < 0 or end_ms - start_ms > max_length:
-        end_ms = max(start_ms + max_length, len(audio))
+        end_ms = max(start_ms + max_length, get_duration_ms(audio_path))
     if not need_crop:
         # Already cropped or no need to crop
         return audio_path, start_ms, end_ms
-    cropped_audio = audio[start_ms : end_ms]
-    cropped_audio.export(audio_path, format=output_format)
+    # ffmpeg cannot write over its own input, so crop to a temporary file first.
+    # Seeking before -i jumps straight to the window and stream copy skips decoding;
+    # re-encode only when the source codec cannot be copied into output_format.
+    tmp_path = f"{audio_path}.crop"
+    window = ["-ss", f"{start_ms / 1000:.3f}", "-t", f"{(end_ms - start_ms) / 1000:.3f}", "-i", audio_path, "-vn"]
+    try:
+        try:
+            run_ffmpeg(*window, "-c", "copy", "-f", output_format, tmp_path)
+        except subprocess.CalledProcessError:
+            run_ffmpeg(*window, "-f", output_format, tmp_path)
+        os.replace(tmp_path, audio_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if os.path.exists(uncropped_marker(audio_path)):
+        os.remove(uncropped_marker(audio_path))
     return audio_path, start_ms, end_ms
 
 
+def crop_audio_batch(specs, output_format="mp3", max_length=15000, workers=None) -> list[tuple[str, int, int] | None]:
+    """Crop many (audio_path, start_ms, end_ms, need_crop) specs concurrently, in input order.
+
+    specs may be a generator: each crop is submitted as soon as its spec is produced, so crops
+    overlap whatever produces them (e.g. downloads still running). Each crop runs in its own ffmpeg
+    subprocess, so threads give real parallelism across cores. A crop that fails is logged and gives None.
+    """
+    def crop(spec):
+        audio_path, start_ms, end_ms, need_crop = spec
+        try:
+            return crop_audio(
+                audio_path,
+                start_ms,
+                end_ms,
+                output_format=output_format,
+                max_length=max_length,
+                need_crop=need_crop,
+            )
+        except Exception as e:
+            print(f"Error cropping {audio_path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        return list(executor.map(crop, specs))
+
+
 if __name__ == "__main__":
     # Example usage
-    download_from_yt("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
-    download_from_google_drive(
-        "https://drive.google.com/file/d/1gPi5zsAtaqaEbzSpBuT-Wrfii5EBBvfi/view?usp=sharing"
+    download_batch(["https://www.youtube.com/watch?v=dQw4w9WgXcQ"], kind="yt")
+    download_batch(
+        ["https://drive.google.com/file/d/1gPi5zsAtaqaEbzSpBuT-Wrfii5EBBvfi/view?usp=sharing"],
+        kind="drive",
     )